@@ -1,158 +1,3251 @@
+import time
+PROCESS_START = time.perf_counter()
+
 import asyncio
-import webview
-from g4f.client import Client
 import json
-import time
 import os
 import logging
+import logging.handlers
+import queue
+import random
+import atexit
 import sys
 import webbrowser
+import mmap
+import re
+import hashlib
+import base64
+import gzip
+import io
+import urllib.request
+import http.client
+import importlib.util
+import socket
+from urllib.parse import urljoin, urlsplit
+import argparse
+import bisect
+import heapq
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
+import sqlite3
+import threading
+
+@lru_cache(maxsize=None)
+def optional_import(name):
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+HTTPX_AVAILABLE = importlib.util.find_spec('httpx') is not None
+HTTP2_AVAILABLE = HTTPX_AVAILABLE and importlib.util.find_spec('h2') is not None
+ZSTD_AVAILABLE = importlib.util.find_spec('zstandard') is not None
 
 if sys.platform.startswith('win'):
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-    ]
-)
+REDACTED_FIELDS = {'prompt', 'response', 'text', 'content', 'messages'}
+
+def log_event(event, level=logging.INFO, **fields):
+    logger = logging.getLogger()
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'fields': fields})
+
+def redact(fields):
+    return {
+        key: f"<{len(value)} chars>" if key in REDACTED_FIELDS and isinstance(value, (str, list)) else value
+        for key, value in fields.items()
+    }
+
+def describe_url(url):
+    if url.startswith('data:'):
+        return f"{url.partition(',')[0][:64]},<{len(url)} chars>"
+    return url
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        event = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'event': record.getMessage(),
+        }
+        event.update(redact(getattr(record, 'fields', None) or {}))
+        return json.dumps(event, default=str)
+
+class ConsoleFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        fields = redact(getattr(record, 'fields', None) or {})
+        return line + ''.join(f" {key}={value}" for key, value in fields.items())
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+def setup_logging(level='INFO', sample_rate=1.0, log_dir=None, console=sys.stdout,
+                  max_bytes=5 * 1024 * 1024, backups=5):
+    log_dir = log_dir or os.path.join(os.path.expanduser("~"), 'SnarkyAI', 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(log_dir, 'snarkyai.log'), maxBytes=max_bytes, backupCount=backups, encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if console is not None:
+        console_handler = logging.StreamHandler(console)
+        console_handler.setFormatter(ConsoleFormatter('%(asctime)s - %(levelname)s - %(message)s'))
+        handlers.append(console_handler)
+
+    log_queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+STREAM_PUSH_INTERVAL = 0.05
+THUMBNAIL_SIZE = 384
+
+AUTO_MODEL = 'auto'
+HEDGE_MIN_SAMPLES = 10
+ROUTE_CANDIDATES = [
+    'gpt-4o-mini',
+    'gpt-4',
+    'claude-3.5-haiku',
+    'claude-3.5-sonnet',
+    'mistral-nemo',
+    'mixtral-7b',
+    'blackboxai',
+]
+G4F_TEXT_MODELS = [
+    ('gpt-4', 'GPT-4'),
+    ('gpt-4o-mini', 'GPT-4o-Mini'),
+    ('claude-3.5-sonnet', 'Claude 3.5 Sonnet'),
+    ('claude-3.5-haiku', 'Claude 3.5 Haiku'),
+    ('blackboxai', 'BlackBoxAI'),
+    ('mixtral-7b', 'Mixtral-7B'),
+    ('mistral-nemo', 'Mistral Nemo'),
+]
+G4F_IMAGE_MODELS = [
+    ('dall-e-3', 'DALL-E 3'),
+    ('flux', 'Flux'),
+]
+COMPARE_DEFAULTS = ['gpt-4', 'claude-3.5-sonnet', 'mistral-nemo']
+
+MODEL_CONTEXT_BUDGETS = {
+    'gpt-4': 6000,
+    'gpt-4o-mini': 16000,
+    'claude-3.5-sonnet': 16000,
+    'claude-3.5-haiku': 16000,
+    'blackboxai': 6000,
+    'mixtral-7b': 6000,
+    'mistral-nemo': 12000,
+}
+DEFAULT_CONTEXT_BUDGET = 4000
+MESSAGE_TOKEN_OVERHEAD = 4
+
+METRIC_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+IMAGE_SIGNATURES = [
+    (b'\x89PNG', 'image/png', 'png'),
+    (b'\xff\xd8', 'image/jpeg', 'jpg'),
+    (b'GIF8', 'image/gif', 'gif'),
+    (b'RIFF', 'image/webp', 'webp'),
+]
+
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+SEARCH_PREFIX_MIN = 2
+
+def message_text(message):
+    return message.get('user') or message.get('ai') or ''
+
+def make_snippet(text, tokens, width=80):
+    lowered = text.lower()
+    positions = [lowered.find(token) for token in tokens]
+    positions = [position for position in positions if position >= 0]
+    center = min(positions) if positions else 0
+    start = max(center - width // 2, 0)
+    end = min(start + width, len(text))
+    snippet = text[start:end]
+    for token in sorted(set(tokens), key=len, reverse=True):
+        snippet = re.sub(f"(?i)({re.escape(token)})", f"{SNIPPET_START}\\1{SNIPPET_END}", snippet)
+    return ('…' if start else '') + ' '.join(snippet.split()) + ('…' if end < len(text) else '')
+
+class InvertedIndex:
+    def __init__(self):
+        self.postings = {}
+        self.words = []
+        self.titles = {}
+        self.counts = {}
+        self.chat_tokens = {}
+
+    def add(self, chat_id, title=None, messages=()):
+        if title is not None:
+            self.titles[chat_id] = title
+        start = self.counts.get(chat_id, 0)
+        tokens = self.chat_tokens.setdefault(chat_id, set())
+        for index, message in enumerate(messages, start):
+            for token in WORD_RE.findall(message_text(message).lower()):
+                entry = self.postings.get(token)
+                if entry is None:
+                    entry = self.postings[token] = {}
+                    bisect.insort(self.words, token)
+                key = (chat_id, index)
+                entry[key] = entry.get(key, 0) + 1
+                tokens.add(token)
+        self.counts[chat_id] = start + len(messages)
+
+    def remove(self, chat_id):
+        count = self.counts.pop(chat_id, 0)
+        for token in self.chat_tokens.pop(chat_id, ()):
+            entry = self.postings[token]
+            for index in range(count):
+                entry.pop((chat_id, index), None)
+            if not entry:
+                del self.postings[token]
+                del self.words[bisect.bisect_left(self.words, token)]
+
+    def expand(self, prefix):
+        if len(prefix) < SEARCH_PREFIX_MIN:
+            return [prefix] if prefix in self.postings else []
+        start = bisect.bisect_left(self.words, prefix)
+        end = bisect.bisect_left(self.words, prefix + '\U0010ffff', start)
+        return self.words[start:end]
+
+    def match(self, query, limit=20):
+        tokens = WORD_RE.findall(query.lower())
+        if not tokens:
+            return tokens, []
+        terms = [[token] if token in self.postings else [] for token in tokens[:-1]]
+        terms.append(self.expand(tokens[-1]))
+        terms.sort(key=lambda words: sum(len(self.postings[word]) for word in words))
+        scores = None
+        for words in terms:
+            term_scores = {}
+            for word in words:
+                for key, count in self.postings[word].items():
+                    if scores is None or key in scores:
+                        term_scores[key] = term_scores.get(key, 0) + count
+            if scores is not None:
+                for key in term_scores:
+                    term_scores[key] += scores[key]
+            scores = term_scores
+            if not scores:
+                return tokens, []
+        ranked = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0]))
+        return tokens, [(chat_id, index, self.titles.get(chat_id, '')) for (chat_id, index), _ in ranked]
+
+def chat_title(messages, length=60):
+    for message in messages:
+        if 'user' in message:
+            return message['user'][:length]
+    return ''
+
+class HistoryJournal:
+    def __init__(self, history_file, compact_every=500):
+        base = os.path.splitext(history_file)[0]
+        self.legacy_file = history_file
+        self.snapshot_file = base + '.snapshot.jsonl'
+        self.journal_file = base + '.journal.jsonl'
+        self.index_file = base + '.idx'
+        self.compact_every = compact_every
+        self.pending = 0
+        self.lock = threading.Lock()
+        self._journal = None
+        self.offsets = None
+        self.search_index = InvertedIndex()
+
+    def load(self):
+        with self.lock:
+            if os.path.exists(self.snapshot_file):
+                chats = self._read_snapshot()
+            elif os.path.exists(self.legacy_file):
+                with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                    chats = json.load(f)
+                for index, chat in enumerate(chats):
+                    chat.setdefault('id', index)
+                    chat.setdefault('title', chat_title(chat['messages']))
+                logging.debug(f"Migrating legacy chat history from {self.legacy_file}.")
+                self._write_snapshot(chats)
+            else:
+                chats = []
+            self.pending = self._replay(chats)
+            self.search_index = InvertedIndex()
+            for chat in chats:
+                self.search_index.add(chat['id'], chat['title'], chat['messages'] or [])
+            return chats
+
+    def _read_index(self):
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('size') == os.path.getsize(self.snapshot_file):
+                return index['offsets']
+        except Exception as e:
+            logging.debug(f"Snapshot index unavailable, reading whole snapshot: {e}")
+        return None
+
+    def _read_snapshot(self):
+        offsets = self._read_index()
+        self.offsets = dict(offsets) if offsets is not None else None
+        chats = []
+        if os.path.getsize(self.snapshot_file) == 0:
+            return chats
+        with open(self.snapshot_file, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for line in iter(mm.readline, b''):
+                    if line.strip():
+                        chats.append(json.loads(line))
+        return chats
+
+    def _replay(self, chats):
+        if not os.path.exists(self.journal_file):
+            return 0
+        by_id = {chat['id']: chat for chat in chats}
+        records = 0
+        valid_size = 0
+        with open(self.journal_file, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.error("Truncated record at the end of the chat journal, discarding it.")
+                    break
+                valid_size += len(line)
+                records += 1
+                if record['op'] == 'chat':
+                    if record['id'] in by_id:
+                        continue
+                    chat = {'id': record['id'], 'title': record.get('title', ''), 'timestamp': record['timestamp'], 'messages': []}
+                    chats.append(chat)
+                    by_id[chat['id']] = chat
+                elif record['op'] == 'message':
+                    chat = by_id.get(record['chat'])
+                    if chat is not None:
+                        if chat['messages'] is None:
+                            chat['messages'] = []
+                        chat['messages'].append(record['message'])
+                    else:
+                        logging.error(f"Journal message references unknown chat {record['chat']}.")
+                elif record['op'] == 'drop':
+                    chat = by_id.get(record['chat'])
+                    if chat is not None:
+                        chat['messages'] = []
+        if valid_size < os.path.getsize(self.journal_file):
+            with open(self.journal_file, 'r+b') as f:
+                f.truncate(valid_size)
+        return records
+
+    def _journal_messages(self):
+        by_chat = {}
+        dropped = set()
+        if self._journal is not None:
+            self._journal.flush()
+        if not os.path.exists(self.journal_file):
+            return by_chat, dropped
+        with open(self.journal_file, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if record['op'] == 'message':
+                    by_chat.setdefault(record['chat'], []).append(record['message'])
+                elif record['op'] == 'drop':
+                    by_chat[record['chat']] = []
+                    dropped.add(record['chat'])
+        return by_chat, dropped
+
+    def _scan_offsets(self):
+        offsets = {}
+        with open(self.snapshot_file, 'rb') as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    offsets[json.loads(line)['id']] = offset
+                offset += len(line)
+        return offsets
+
+    def _snapshot_messages(self, chat_id, snapshot=None):
+        if not os.path.exists(self.snapshot_file):
+            return []
+        if self.offsets is None:
+            self.offsets = self._scan_offsets()
+        offset = self.offsets.get(chat_id)
+        if offset is None:
+            return []
+        f = snapshot or open(self.snapshot_file, 'rb')
+        try:
+            f.seek(offset)
+            return json.loads(f.readline())['messages'] or []
+        finally:
+            if snapshot is None:
+                f.close()
+
+    def load_messages(self, chat_id):
+        return self._load_messages([chat_id])[chat_id]
+
+    def _load_messages(self, chat_ids):
+        with self.lock:
+            journal, dropped = self._journal_messages()
+            return {
+                chat_id: ([] if chat_id in dropped else self._snapshot_messages(chat_id)) + journal.get(chat_id, [])
+                for chat_id in chat_ids
+            }
+
+    def _write_snapshot(self, chats, from_disk=False):
+        offsets = []
+        journal, dropped = self._journal_messages() if from_disk else ({}, set())
+        snapshot = open(self.snapshot_file, 'rb') if from_disk and os.path.exists(self.snapshot_file) else None
+        tmp_file = self.snapshot_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                for chat in chats:
+                    messages = chat['messages']
+                    if from_disk:
+                        skip = chat['id'] in dropped or snapshot is None
+                        messages = [] if skip else self._snapshot_messages(chat['id'], snapshot)
+                        messages = messages + journal.get(chat['id'], [])
+                    record = {'id': chat['id'], 'title': chat['title'], 'timestamp': chat['timestamp'], 'messages': messages}
+                    offsets.append([chat['id'], f.tell()])
+                    f.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+                size = f.tell()
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+        os.replace(tmp_file, self.snapshot_file)
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'size': size, 'offsets': offsets}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.index_file)
+        self.offsets = dict(offsets)
+
+    def _append(self, records):
+        data = b''.join(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n' for record in records)
+        with self.lock:
+            if self._journal is None:
+                self._journal = open(self.journal_file, 'ab')
+            offset = self._journal.tell()
+            try:
+                self._journal.write(data)
+                self._journal.flush()
+            except OSError:
+                self._discard_partial_write(offset)
+                raise
+            self.pending += len(records)
+
+    def _discard_partial_write(self, offset):
+        journal, self._journal = self._journal, None
+        try:
+            journal.close()
+        except OSError:
+            pass
+        try:
+            os.truncate(self.journal_file, offset)
+        except OSError as e:
+            logging.error(f"Error discarding a partial chat journal write: {e}")
+
+    def sync(self):
+        with self.lock:
+            if self._journal is not None:
+                os.fsync(self._journal.fileno())
+
+    def append_chat(self, chat):
+        self._append([{'op': 'chat', 'id': chat['id'], 'title': chat['title'], 'timestamp': chat['timestamp']}])
+        with self.lock:
+            self.search_index.add(chat['id'], chat['title'])
+
+    def append_messages(self, chat_id, messages):
+        self._append([{'op': 'message', 'chat': chat_id, 'message': message} for message in messages])
+        with self.lock:
+            self.search_index.add(chat_id, messages=messages)
+
+    def drop_messages(self, chat_id):
+        self._append([{'op': 'drop', 'chat': chat_id}])
+        with self.lock:
+            self.search_index.remove(chat_id)
+
+    def search(self, query, limit=20):
+        with self.lock:
+            tokens, ranked = self.search_index.match(query, limit)
+        loaded = self._load_messages({chat_id for chat_id, _, _ in ranked})
+        results = []
+        for chat_id, index, title in ranked:
+            if index >= len(loaded[chat_id]):
+                continue
+            message = loaded[chat_id][index]
+            results.append({
+                'chat_id': chat_id,
+                'title': title,
+                'index': index,
+                'role': 'user' if 'user' in message else 'ai',
+                'snippet': make_snippet(message_text(message), tokens),
+            })
+        return results
+
+    def needs_compaction(self):
+        return self.pending >= self.compact_every
+
+    def compact(self, chats):
+        with self.lock:
+            self._write_snapshot(chats, from_disk=True)
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            open(self.journal_file, 'wb').close()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+class SqliteHistoryStore:
+    def __init__(self, history_file):
+        self.legacy_file = history_file
+        self.db_file = os.path.splitext(history_file)[0] + '.db'
+        self.lock = threading.Lock()
+        self.error = None
+        self.db = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS chats (
+                id INTEGER PRIMARY KEY,
+                title TEXT NOT NULL DEFAULT '',
+                timestamp REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL REFERENCES chats(id),
+                timestamp REAL NOT NULL,
+                body TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_chats_timestamp ON chats(timestamp);
+            CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id, id);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        ''')
+        self._create_search_index()
+        if self.db.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone() is None:
+            try:
+                self.migrate_from_json()
+            except Exception as e:
+                logging.error(f"Error migrating legacy chat history: {e}")
+                self.error = f"legacy history could not be migrated: {e}"
+
+    def _create_search_index(self):
+        existing = self.db.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+        ).fetchone()
+        if existing and 'prefix' in existing[0]:
+            return
+        if existing:
+            self.db.executescript('''
+                DROP TRIGGER IF EXISTS messages_fts_insert;
+                DROP TRIGGER IF EXISTS messages_fts_delete;
+                DROP TABLE messages_fts;
+            ''')
+        self.db.executescript('''
+            CREATE VIRTUAL TABLE messages_fts USING fts5(text, tokenize='unicode61', prefix='2 3');
+            CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, text)
+                VALUES (new.id, coalesce(json_extract(new.body, '$.user'), json_extract(new.body, '$.ai'), ''));
+            END;
+            CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+                DELETE FROM messages_fts WHERE rowid = old.id;
+            END;
+            INSERT INTO messages_fts (rowid, text)
+            SELECT id, coalesce(json_extract(body, '$.user'), json_extract(body, '$.ai'), '') FROM messages;
+        ''')
+
+    def migrate_from_json(self):
+        journal = HistoryJournal(self.legacy_file)
+        sources = [journal.legacy_file, journal.snapshot_file, journal.journal_file]
+        chats = []
+        if any(os.path.exists(path) for path in sources):
+            try:
+                chats = journal.load()
+            finally:
+                journal.close()
+        with self.lock, self.db:
+            first_id = self.db.execute('SELECT COALESCE(MAX(id), -1) + 1 FROM chats').fetchone()[0]
+            self.db.executemany(
+                'INSERT INTO chats (id, title, timestamp) VALUES (?, ?, ?)',
+                [(first_id + chat['id'], chat.get('title') or chat_title(chat['messages']), chat['timestamp'])
+                 for chat in chats]
+            )
+            self.db.executemany(
+                'INSERT INTO messages (chat_id, timestamp, body) VALUES (?, ?, ?)',
+                [(first_id + chat['id'], chat['timestamp'], json.dumps(message, ensure_ascii=False))
+                 for chat in chats for message in chat['messages']]
+            )
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', ?)", (str(time.time()),))
+        for path in sources + [journal.index_file]:
+            if os.path.exists(path):
+                os.replace(path, path + '.migrated')
+        logging.debug(f"Migrated {len(chats)} chats into {self.db_file}.")
+        return len(chats)
+
+    def load(self):
+        with self.lock:
+            rows = self.db.execute('SELECT id, title, timestamp FROM chats ORDER BY id').fetchall()
+        return [{'id': chat_id, 'title': title, 'timestamp': timestamp, 'messages': None}
+                for chat_id, title, timestamp in rows]
+
+    def load_messages(self, chat_id):
+        with self.lock:
+            rows = self.db.execute('SELECT body FROM messages WHERE chat_id = ? ORDER BY id', (chat_id,)).fetchall()
+        return [json.loads(body) for body, in rows]
+
+    def append_chat(self, chat):
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT INTO chats (id, title, timestamp) VALUES (?, ?, ?)',
+                (chat['id'], chat['title'], chat['timestamp'])
+            )
+
+    def append_messages(self, chat_id, messages):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT INTO messages (chat_id, timestamp, body) VALUES (?, ?, ?)',
+                [(chat_id, now, json.dumps(message, ensure_ascii=False)) for message in messages]
+            )
+
+    def drop_messages(self, chat_id):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+
+    def search(self, query, limit=20):
+        tokens = WORD_RE.findall(query)
+        if not tokens:
+            return []
+        match = ' '.join('"' + token.replace('"', '""') + '"' for token in tokens)
+        if len(tokens[-1]) >= SEARCH_PREFIX_MIN:
+            match += '*'
+        with self.lock:
+            rows = self.db.execute(
+                '''SELECT m.id, m.chat_id, c.title, m.body,
+                          snippet(messages_fts, 0, char(2), char(3), '…', 16)
+                   FROM messages_fts
+                   JOIN messages m ON m.id = messages_fts.rowid
+                   JOIN chats c ON c.id = m.chat_id
+                   WHERE messages_fts MATCH ?
+                   ORDER BY rank
+                   LIMIT ?''',
+                (match, limit)
+            ).fetchall()
+            results = []
+            for message_id, chat_id, title, body, snippet in rows:
+                index = self.db.execute(
+                    'SELECT COUNT(*) FROM messages WHERE chat_id = ? AND id < ?', (chat_id, message_id)
+                ).fetchone()[0]
+                results.append({
+                    'chat_id': chat_id,
+                    'title': title,
+                    'index': index,
+                    'role': 'user' if 'user' in json.loads(body) else 'ai',
+                    'snippet': snippet,
+                })
+        return results
+
+    def sync(self):
+        pass
+
+    def needs_compaction(self):
+        return False
+
+    def compact(self, chats):
+        with self.lock:
+            self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class ChatArchive:
+    def __init__(self, archive_dir, codec=None):
+        self.archive_dir = archive_dir
+        os.makedirs(archive_dir, exist_ok=True)
+        self.codec = codec or ('zst' if ZSTD_AVAILABLE else 'gz')
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(archive_dir, 'archive.db'), check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS archived (chat_id INTEGER PRIMARY KEY, segment TEXT NOT NULL, '
+            '"offset" INTEGER NOT NULL, length INTEGER NOT NULL, raw_size INTEGER NOT NULL, archived_at REAL NOT NULL)'
+        )
+        self.archived = {chat_id for chat_id, in self.db.execute('SELECT chat_id FROM archived')}
+
+    @staticmethod
+    def _compress(data, codec):
+        if codec == 'zst':
+            return optional_import('zstandard').ZstdCompressor(level=19).compress(data)
+        return gzip.compress(data, 9)
+
+    @staticmethod
+    def _decompress(data, segment):
+        if segment.endswith('.zst'):
+            zstandard = optional_import('zstandard')
+            if zstandard is None:
+                raise RuntimeError(f"zstandard is required to read archive segment {segment}")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
+
+    def contains(self, chat_id):
+        return chat_id in self.archived
+
+    def add(self, chats):
+        by_segment = {}
+        for chat in chats:
+            segment = f"{time.strftime('%Y-%m', time.localtime(chat['timestamp']))}.jsonl.{self.codec}"
+            by_segment.setdefault(segment, []).append(chat)
+        rows = []
+        now = time.time()
+        with self.lock:
+            for segment, segment_chats in by_segment.items():
+                with open(os.path.join(self.archive_dir, segment), 'ab') as f:
+                    for chat in segment_chats:
+                        payload = json.dumps(chat, ensure_ascii=False).encode('utf-8') + b'\n'
+                        frame = self._compress(payload, self.codec)
+                        rows.append((chat['id'], segment, f.tell(), len(frame), len(payload), now))
+                        f.write(frame)
+                    f.flush()
+                    os.fsync(f.fileno())
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO archived VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.archived.update(row[0] for row in rows)
+        return rows
+
+    def load(self, chat_id):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT segment, "offset", length FROM archived WHERE chat_id = ?', (chat_id,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(f"Chat {chat_id} is not archived")
+            segment, offset, length = row
+            with open(os.path.join(self.archive_dir, segment), 'rb') as f:
+                f.seek(offset)
+                frame = f.read(length)
+        return json.loads(self._decompress(frame, segment))['messages']
+
+    def remove(self, chat_id):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM archived WHERE chat_id = ?', (chat_id,))
+            self.archived.discard(chat_id)
+
+    def compact(self, min_live=0.5):
+        rewritten = 0
+        with self.lock:
+            for segment in os.listdir(self.archive_dir):
+                if '.jsonl.' not in segment:
+                    continue
+                path = os.path.join(self.archive_dir, segment)
+                rows = self.db.execute(
+                    'SELECT chat_id, "offset", length FROM archived WHERE segment = ? ORDER BY "offset"', (segment,)
+                ).fetchall()
+                if sum(length for _, _, length in rows) >= os.path.getsize(path) * min_live:
+                    continue
+                offsets = []
+                with open(path, 'rb') as source, open(path + '.tmp', 'wb') as target:
+                    for chat_id, offset, length in rows:
+                        source.seek(offset)
+                        offsets.append((target.tell(), chat_id))
+                        target.write(source.read(length))
+                    target.flush()
+                    os.fsync(target.fileno())
+                if rows:
+                    os.replace(path + '.tmp', path)
+                else:
+                    os.remove(path + '.tmp')
+                    os.remove(path)
+                with self.db:
+                    self.db.executemany('UPDATE archived SET "offset" = ? WHERE chat_id = ?', offsets)
+                rewritten += 1
+        return rewritten
+
+    def get_stats(self):
+        with self.lock:
+            chats, raw, compressed, segments = self.db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(raw_size), 0), COALESCE(SUM(length), 0), COUNT(DISTINCT segment) '
+                'FROM archived'
+            ).fetchone()
+        return {
+            'codec': self.codec,
+            'chats': chats,
+            'segments': segments,
+            'raw_bytes': raw,
+            'compressed_bytes': compressed,
+            'ratio': round(raw / compressed, 2) if compressed else None,
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class ResponseCache:
+    def __init__(self, cache_file, max_entries=256, ttl=24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'merged': 0, 'evictions': 0, 'expired': 0}
+        self.db = sqlite3.connect(cache_file, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, expires REAL NOT NULL)'
+        )
+        with self.db:
+            self.db.execute('DELETE FROM responses WHERE expires < ?', (time.time(),))
+
+    @staticmethod
+    def make_key(model, messages, params):
+        normalized = [{'role': m['role'], 'content': ' '.join(m['content'].split())} for m in messages]
+        payload = json.dumps([model, normalized, params], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] >= now:
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[1]
+                del self.entries[key]
+                self.stats['expired'] += 1
+            row = self.db.execute('SELECT response, expires FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[1] >= now:
+                self._remember(key, row[0], row[1])
+                self.stats['disk_hits'] += 1
+                return row[0]
+            self.stats['misses'] += 1
+            return None
+
+    def _remember(self, key, value, expires):
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def put(self, key, value):
+        expires = time.time() + self.ttl
+        with self.lock:
+            self._remember(key, value, expires)
+            with self.db:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO responses (key, response, expires) VALUES (?, ?, ?)',
+                    (key, value, expires)
+                )
+
+    def get_or_compute(self, key, compute, bypass=False, wait=None):
+        while True:
+            if not bypass:
+                value = self.get(key)
+                if value is not None:
+                    return value
+            with self.lock:
+                future = self.inflight.get(key)
+                owner = future is None
+                if owner:
+                    future = Future()
+                    self.inflight[key] = future
+                else:
+                    self.stats['merged'] += 1
+            if owner:
+                break
+            try:
+                return wait(future) if wait is not None else future.result()
+            except GenerationCancelled:
+                if not (future.done() and isinstance(future.exception(), GenerationCancelled)):
+                    raise
+        try:
+            value = compute()
+            self.put(key, value)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+            stats['disk_entries'] = self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            stats['inflight'] = len(self.inflight)
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class DnsCache:
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.resolve = socket.getaddrinfo
+
+    def getaddrinfo(self, host, port, *args, **kwargs):
+        key = (host, port, args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        result = self.resolve(host, port, *args, **kwargs)
+        with self.lock:
+            self.entries[key] = (now + self.ttl, result)
+        return result
+
+    def addresses(self, host, port):
+        return list(dict.fromkeys(sockaddr[0] for *_, sockaddr in self.getaddrinfo(host, port, 0, socket.SOCK_STREAM)))
+
+    @staticmethod
+    def connect(addresses, open_socket, errors=(OSError,)):
+        error = None
+        for address in addresses:
+            try:
+                return open_socket(address)
+            except errors as e:
+                error = e
+        raise error
+
+    def create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        host, port = address
+        return self.connect(self.addresses(host, port),
+                            lambda ip: socket.create_connection((ip, port), timeout, source_address))
+
+    def network_backend(self):
+        httpcore = optional_import('httpcore')
+        dns = self
+
+        class CachedDnsBackend(httpcore.SyncBackend):
+            def connect_tcp(self, host, port, *args, **kwargs):
+                try:
+                    addresses = dns.addresses(host, port)
+                except OSError as e:
+                    raise httpcore.ConnectError(str(e)) from e
+                connect = super().connect_tcp
+                return dns.connect(addresses, lambda ip: connect(ip, port, *args, **kwargs),
+                                   (httpcore.ConnectError, httpcore.ConnectTimeout))
+
+        return CachedDnsBackend()
+
+class HttpSession:
+    def __init__(self, pool_size=10, timeout=60, keepalive_expiry=120, dns_ttl=300, warm_interval=60):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.keepalive_expiry = keepalive_expiry
+        self.warm_interval = warm_interval
+        self.headers = {'User-Agent': 'SnarkyAI'}
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.warmed = {}
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='http-warmup')
+        self.dns = DnsCache(dns_ttl)
+        self._client = None
+        self.client_ready = not HTTPX_AVAILABLE
+        logging.debug(f"HTTP session using {'httpx' if HTTPX_AVAILABLE else 'http.client'}"
+                      f"{' with HTTP/2' if HTTP2_AVAILABLE else ''}, pool size {pool_size}.")
+
+    @property
+    def client(self):
+        with self.lock:
+            if not self.client_ready:
+                self.client_ready = True
+                httpx = optional_import('httpx')
+                if httpx is not None:
+                    transport = httpx.HTTPTransport(
+                        http2=HTTP2_AVAILABLE,
+                        limits=httpx.Limits(
+                            max_connections=self.pool_size,
+                            max_keepalive_connections=self.pool_size,
+                            keepalive_expiry=self.keepalive_expiry
+                        )
+                    )
+                    transport._pool._network_backend = self.dns.network_backend()
+                    self._client = httpx.Client(
+                        transport=transport,
+                        timeout=self.timeout,
+                        headers=self.headers,
+                        follow_redirects=True
+                    )
+            return self._client
+
+    @staticmethod
+    def _origin(url):
+        parts = urlsplit(url)
+        return parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)
+
+    def _connection(self, origin):
+        now = time.monotonic()
+        with self.lock:
+            idle = self.pools.get(origin, [])
+            while idle:
+                connection, last_used = idle.pop()
+                if now - last_used < self.keepalive_expiry:
+                    return connection, True
+                connection.close()
+        scheme, host, port = origin
+        factory = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        connection = factory(host, port, timeout=self.timeout)
+        connection._create_connection = self.dns.create_connection
+        return connection, False
+
+    def _release(self, origin, connection):
+        with self.lock:
+            idle = self.pools.setdefault(origin, [])
+            if len(idle) < self.pool_size:
+                idle.append((connection, time.monotonic()))
+                return
+        connection.close()
+
+    @contextmanager
+    def _abort_on_cancel(self, cancel):
+        registered = []
+
+        def on_cancel(abort):
+            if cancel is not None:
+                registered.append(abort)
+                cancel.on_cancel(abort)
+
+        if cancel is not None:
+            cancel.check()
+        try:
+            yield on_cancel
+        except Exception:
+            if cancel is not None:
+                cancel.check()
+            raise
+        finally:
+            for abort in registered:
+                cancel.off_cancel(abort)
+        if cancel is not None:
+            cancel.check()
+
+    @staticmethod
+    def _shutdown(sock):
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _abort_connection(self, connection):
+        connection.auto_open = 0
+        self._shutdown(connection.sock)
+        connection.close()
+
+    def _abort_response(self, response):
+        stream = response.extensions.get('network_stream')
+        if stream is not None and response.http_version != 'HTTP/2':
+            self._shutdown(stream.get_extra_info('socket'))
+        response.close()
+
+    def _send(self, method, url, body=None, headers=None, timeout=None, on_cancel=None):
+        origin = self._origin(url)
+        parts = urlsplit(url)
+        path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        connection, reused = self._connection(origin)
+        if on_cancel is not None:
+            on_cancel(lambda: self._abort_connection(connection))
+        connection.timeout = timeout or self.timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(connection.timeout)
+        try:
+            connection.request(method, path, body=body, headers={**self.headers, **(headers or {})})
+            return origin, connection, connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            if not reused:
+                raise
+            return self._send(method, url, body, headers, timeout, on_cancel)
+
+    def _finish(self, origin, connection, response):
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(origin, connection)
+
+    def _request(self, method, url, redirects=5, body=None, headers=None, timeout=None, cancel=None):
+        with self._abort_on_cancel(cancel) as on_cancel:
+            origin, connection, response = self._send(method, url, body, headers, timeout, on_cancel)
+            try:
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                raise
+        self._finish(origin, connection, response)
+        if response.status in (301, 302, 303, 307, 308) and redirects and response.getheader('Location'):
+            return self._request(method, urljoin(url, response.getheader('Location')), redirects - 1)
+        if response.status >= 400:
+            raise RuntimeError(f"HTTP {response.status} for {url}")
+        return data
+
+    def request_json(self, method, url, payload=None, headers=None, timeout=None, cancel=None):
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        headers = {'Content-Type': 'application/json', **(headers or {})}
+        client = self.client
+        if client is not None:
+            with self._abort_on_cancel(cancel) as on_cancel:
+                with client.stream(method, url, content=body, headers=headers,
+                                   timeout=timeout or self.timeout) as response:
+                    on_cancel(lambda: self._abort_response(response))
+                    response.read()
+            response.raise_for_status()
+            return response.json()
+        return json.loads(self._request(method, url, 0, body, headers, timeout, cancel))
+
+    def stream_lines(self, url, payload, headers=None, timeout=None, cancel=None):
+        body = json.dumps(payload).encode('utf-8')
+        headers = {'Content-Type': 'application/json', 'Accept': 'text/event-stream', **(headers or {})}
+        client = self.client
+        if client is not None:
+            with self._abort_on_cancel(cancel) as on_cancel:
+                with client.stream('POST', url, content=body, headers=headers,
+                                   timeout=timeout or self.timeout) as response:
+                    on_cancel(lambda: self._abort_response(response))
+                    response.raise_for_status()
+                    yield from response.iter_lines()
+            return
+        with self._abort_on_cancel(cancel) as on_cancel:
+            origin, connection, response = self._send('POST', url, body, headers, timeout, on_cancel)
+            complete = False
+            try:
+                if response.status >= 400:
+                    raise RuntimeError(f"HTTP {response.status} for {url}")
+                for line in response:
+                    yield line.decode('utf-8').rstrip('\r\n')
+                complete = True
+            finally:
+                if not complete:
+                    connection.close()
+        self._finish(origin, connection, response)
+
+    def get(self, url):
+        client = self.client
+        if client is not None:
+            response = client.get(url)
+            response.raise_for_status()
+            return response.content
+        return self._request('GET', url)
+
+    def _warm(self, url):
+        start = time.monotonic()
+        try:
+            client = self.client
+            if client is not None:
+                client.head(url)
+            else:
+                origin = self._origin(url)
+                connection, reused = self._connection(origin)
+                if not reused:
+                    connection.connect()
+                self._release(origin, connection)
+            logging.debug(f"Warmed connection to {url} in {time.monotonic() - start:.2f}s.")
+        except Exception as e:
+            logging.debug(f"Warm-up of {url} failed: {e}")
+
+    def warm(self, urls):
+        now = time.monotonic()
+        scheduled = []
+        for url in urls:
+            origin = self._origin(url)
+            with self.lock:
+                if now - self.warmed.get(origin, -self.warm_interval) < self.warm_interval:
+                    continue
+                self.warmed[origin] = now
+            self.executor.submit(self._warm, url)
+            scheduled.append(url)
+        return scheduled
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            if self._client is not None:
+                self._client.close()
+            self.client_ready = True
+            for idle in self.pools.values():
+                for connection, _ in idle:
+                    connection.close()
+            self.pools = {}
+
+class ImageCache:
+    def __init__(self, cache_dir, session=None, max_workers=2):
+        self.cache_dir = cache_dir
+        self.session = session
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='images')
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'images.db'), check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS images (url TEXT PRIMARY KEY, hash TEXT NOT NULL, mime TEXT NOT NULL, '
+            'ext TEXT NOT NULL, thumbnail INTEGER NOT NULL DEFAULT 0)'
+        )
+
+    def _path(self, digest, suffix):
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.{suffix}")
+
+    def _lookup(self, url):
+        with self.lock:
+            return self.db.execute('SELECT hash, mime, ext, thumbnail FROM images WHERE url = ?', (url,)).fetchone()
+
+    def _fetch(self, url):
+        if url.startswith('data:'):
+            return base64.b64decode(url.split(',', 1)[1])
+        if self.session is not None:
+            return self.session.get(url)
+        request = urllib.request.Request(url, headers={'User-Agent': 'SnarkyAI'})
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.read()
+
+    def _download(self, url):
+        data = self._fetch(url)
+        digest = hashlib.sha256(data).hexdigest()
+        mime, ext = next(((m, e) for magic, m, e in IMAGE_SIGNATURES if data.startswith(magic)), ('application/octet-stream', 'bin'))
+        path = self._path(digest, ext)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+        thumbnail = self._make_thumbnail(digest, data)
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO images (url, hash, mime, ext, thumbnail) VALUES (?, ?, ?, ?, ?)',
+                (url, digest, mime, ext, int(thumbnail))
+            )
+        logging.debug(f"Cached image {describe_url(url)} as {digest} ({len(data)} bytes).")
+        return digest, mime, ext, int(thumbnail)
+
+    def _make_thumbnail(self, digest, data):
+        Image = optional_import('PIL.Image')
+        if Image is None:
+            return False
+        path = self._path(digest, 'thumb.jpg')
+        if os.path.exists(path):
+            return True
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+                image.convert('RGB').save(path, 'JPEG', quality=85)
+            return True
+        except Exception as e:
+            logging.error(f"Error creating thumbnail for {digest}: {e}")
+            return False
+
+    def prefetch(self, url):
+        with self.lock:
+            future = self.pending.get(url)
+            if future is None:
+                future = self.executor.submit(self._download, url)
+                self.pending[url] = future
+                future.add_done_callback(lambda _: self._forget(url))
+        return future
+
+    def _forget(self, url):
+        with self.lock:
+            self.pending.pop(url, None)
+
+    def get(self, url, size='thumb'):
+        row = self._lookup(url)
+        if row is None:
+            row = self.prefetch(url).result()
+        digest, mime, ext, thumbnail = row
+        if size == 'thumb' and thumbnail:
+            path, mime = self._path(digest, 'thumb.jpg'), 'image/jpeg'
+        else:
+            path = self._path(digest, ext)
+        with open(path, 'rb') as f:
+            data = f.read()
+        return f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            self.db.close()
+
+class G4FBackend:
+    name = 'g4f'
+
+    def __init__(self, profile=None):
+        self.profile = profile
+        self.lock = threading.Lock()
+        self._client = None
+
+    @property
+    def client(self):
+        with self.lock:
+            if self._client is None:
+                with self.profile.phase('g4f_import'):
+                    from g4f.client import Client
+                    self._client = Client()
+            return self._client
+
+    @client.setter
+    def client(self, client):
+        with self.lock:
+            self._client = client
+
+    def models(self):
+        return ([{'id': model, 'label': label, 'kind': 'text'} for model, label in G4F_TEXT_MODELS] +
+                [{'id': model, 'label': label, 'kind': 'image'} for model, label in G4F_IMAGE_MODELS])
+
+    def complete(self, model, messages, timeout=None, cancel=None):
+        response = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            web_search=False,
+            timeout=timeout
+        )
+        return response.choices[0].message.content
+
+    def stream(self, model, messages, timeout=None, cancel=None):
+        response = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            web_search=False,
+            stream=True,
+            timeout=timeout
+        )
+        try:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+
+    def generate_image(self, model, prompt, cancel=None):
+        response = self.client.images.generate(
+            model=model,
+            prompt=prompt,
+            response_format="url"
+        )
+        return response.data[0].url
+
+class OpenAIBackend:
+    def __init__(self, base_url, session, api_key=None, name='local', models_ttl=60):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.session = session
+        self.headers = {'Authorization': f"Bearer {api_key}"} if api_key else {}
+        self.models_ttl = models_ttl
+        self.lock = threading.Lock()
+        self.cached = []
+        self.fetched = None
+
+    def models(self):
+        with self.lock:
+            if self.fetched is not None and time.monotonic() - self.fetched < self.models_ttl:
+                return self.cached
+        try:
+            data = self.session.request_json('GET', f"{self.base_url}/models", headers=self.headers, timeout=5)
+            models = [{'id': entry['id'], 'label': f"{entry['id']} ({self.name})", 'kind': 'text'}
+                      for entry in data.get('data', [])]
+        except Exception as e:
+            logging.error(f"Error listing models from {self.base_url}: {e}")
+            models = []
+        with self.lock:
+            self.cached = models
+            self.fetched = time.monotonic()
+        return models
+
+    def complete(self, model, messages, timeout=None, cancel=None):
+        response = self.session.request_json(
+            'POST', f"{self.base_url}/chat/completions", {'model': model, 'messages': messages},
+            self.headers, timeout, cancel
+        )
+        return response['choices'][0]['message']['content']
+
+    def stream(self, model, messages, timeout=None, cancel=None):
+        lines = self.session.stream_lines(
+            f"{self.base_url}/chat/completions", {'model': model, 'messages': messages, 'stream': True},
+            self.headers, timeout, cancel
+        )
+        try:
+            for line in lines:
+                if not line.startswith('data:'):
+                    continue
+                data = line[5:].strip()
+                if data == '[DONE]':
+                    break
+                choices = json.loads(data).get('choices') or []
+                delta = (choices[0].get('delta') or {}).get('content') if choices else None
+                if delta:
+                    yield delta
+        finally:
+            lines.close()
+
+    def generate_image(self, model, prompt, cancel=None):
+        response = self.session.request_json(
+            'POST', f"{self.base_url}/images/generations", {'model': model, 'prompt': prompt, 'response_format': 'url'},
+            self.headers, cancel=cancel
+        )
+        image = response['data'][0]
+        return image.get('url') or f"data:image/png;base64,{image['b64_json']}"
+
+    def urls(self, model):
+        return [self.base_url]
+
+class ModelRouter:
+    def __init__(self, stats_file, candidates=ROUTE_CANDIDATES, deadline=90, alpha=0.2, window=100):
+        self.stats_file = stats_file
+        self.candidates = list(candidates)
+        self.deadline = deadline
+        self.alpha = alpha
+        self.window = window
+        self.fallbacks = {}
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.dirty = 0
+        try:
+            if os.path.exists(stats_file):
+                with open(stats_file, 'r', encoding='utf-8') as f:
+                    self.stats = json.load(f)
+        except Exception as e:
+            logging.error(f"Error loading model statistics: {e}")
+
+    def _entry(self, model):
+        return self.stats.setdefault(model, {
+            'ewma': None,
+            'error_rate': 0.0,
+            'requests': 0,
+            'errors': 0,
+            'samples': [],
+        })
+
+    def record(self, model, latency=None, error=False):
+        with self.lock:
+            entry = self._entry(model)
+            entry['requests'] += 1
+            entry['error_rate'] += self.alpha * ((1.0 if error else 0.0) - entry['error_rate'])
+            if error:
+                entry['errors'] += 1
+            else:
+                entry['ewma'] = latency if entry['ewma'] is None else entry['ewma'] + self.alpha * (latency - entry['ewma'])
+                entry['samples'] = (entry['samples'] + [latency])[-self.window:]
+            self.dirty += 1
+            should_save = self.dirty >= 10
+        if should_save:
+            self.save()
+
+    def expected_latency(self, model):
+        entry = self.stats.get(model)
+        if entry is None:
+            return 0.0
+        if entry['ewma'] is None:
+            return self.deadline * entry['error_rate']
+        return entry['ewma'] * (1 + 4 * entry['error_rate'])
+
+    def record_first_byte(self, model, latency):
+        with self.lock:
+            entry = self._entry(model)
+            entry['first_byte'] = (entry.get('first_byte', []) + [latency])[-self.window:]
+
+    def _percentile(self, model, fraction, field='samples', min_samples=1):
+        samples = sorted(self.stats.get(model, {}).get(field, []))
+        if len(samples) < min_samples:
+            return None
+        return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+    def p95(self, model):
+        return self._percentile(model, 0.95)
+
+    def first_byte_p90(self, model):
+        with self.lock:
+            return self._percentile(model, 0.90, 'first_byte', HEDGE_MIN_SAMPLES)
+
+    def alternate(self, model):
+        with self.lock:
+            return min((candidate for candidate in self.candidates if candidate != model),
+                       key=self.expected_latency, default=None)
+
+    def route(self, model):
+        if model != AUTO_MODEL:
+            fallback = self.fallbacks.get(model)
+            if fallback is None:
+                return [model]
+            return [model] + [candidate for candidate in self.route(fallback) if candidate != model]
+        with self.lock:
+            return sorted(self.candidates, key=self.expected_latency)
+
+    def run(self, model, call, on_failover=None):
+        deadline = time.monotonic() + self.deadline
+        errors = []
+        for index, candidate in enumerate(self.route(model)):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if index and on_failover is not None:
+                on_failover(candidate)
+            start = time.monotonic()
+            try:
+                result, timings = call(candidate, remaining)
+                if result is None:
+                    raise RuntimeError('no response')
+            except GenerationCancelled:
+                raise
+            except Exception as e:
+                self.record(candidate, error=True)
+                logging.error(f"Model {candidate} failed after {time.monotonic() - start:.2f}s: {e}")
+                errors.append(f"{candidate}: {e}")
+                continue
+            for served_by, latency in (timings or {candidate: time.monotonic() - start}).items():
+                self.record(served_by, latency)
+            if index:
+                logging.debug(f"Failed over to {candidate} after {index} failed attempts.")
+            return result
+        if len(errors) == 1:
+            raise RuntimeError(errors[0].split(': ', 1)[1])
+        raise RuntimeError(f"No model answered within {self.deadline}s ({'; '.join(errors) or 'deadline exceeded'})")
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                model: {
+                    'ewma': entry['ewma'],
+                    'p95': self.p95(model),
+                    'first_byte_p90': self._percentile(model, 0.90, 'first_byte'),
+                    'error_rate': entry['error_rate'],
+                    'requests': entry['requests'],
+                    'errors': entry['errors'],
+                    'expected': self.expected_latency(model),
+                }
+                for model, entry in self.stats.items()
+            }
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.stats)
+            self.dirty = 0
+        try:
+            with open(self.stats_file + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(self.stats_file + '.tmp', self.stats_file)
+        except Exception as e:
+            logging.error(f"Error saving model statistics: {e}")
+
+class GenerationCancelled(Exception):
+    def __init__(self, reason, partial=''):
+        super().__init__(reason)
+        self.reason = reason
+        self.partial = partial
+
+    @property
+    def outcome(self):
+        return 'timeout' if self.reason == 'deadline' else 'cancelled'
+
+class CancelToken:
+    def __init__(self, deadline=None):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.seconds = deadline
+        self.deadline = None
+        self.reason = None
+        self.callbacks = []
+        self.chunks = []
+
+    def arm(self):
+        if self.seconds:
+            self.deadline = time.monotonic() + self.seconds
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+    def cancel(self, reason='cancelled'):
+        with self.lock:
+            if self.reason is not None:
+                return False
+            self.reason = reason
+            callbacks, self.callbacks = self.callbacks, []
+        self.event.set()
+        for callback in callbacks:
+            callback()
+        return True
+
+    def on_cancel(self, callback):
+        with self.lock:
+            if self.reason is None:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def off_cancel(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def cancelled(self):
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel('deadline')
+        return self.reason is not None
+
+    def check(self):
+        if self.cancelled():
+            raise GenerationCancelled(self.reason, ''.join(self.chunks).strip())
+
+    def wait(self, future):
+        wake = threading.Event()
+        future.add_done_callback(lambda _: wake.set())
+        self.on_cancel(wake.set)
+        if not wake.wait(self.remaining()):
+            self.cancel('deadline')
+        if not future.done():
+            self.check()
+        return future.result()
+
+class HedgeBudget:
+    def __init__(self, per_day=50):
+        self.per_day = per_day
+        self.lock = threading.Lock()
+        self.day = None
+        self.counts = {}
+
+    def _roll(self):
+        day = time.strftime('%Y-%m-%d')
+        if day != self.day:
+            self.day = day
+            self.counts = {'hedged': 0, 'won': 0, 'wasted': 0}
+
+    def take(self):
+        with self.lock:
+            self._roll()
+            if self.counts['hedged'] >= self.per_day:
+                return False
+            self.counts['hedged'] += 1
+            return True
+
+    def settle(self, won):
+        with self.lock:
+            self._roll()
+            self.counts['won' if won else 'wasted'] += 1
+
+    def get_stats(self):
+        with self.lock:
+            self._roll()
+            return {'day': self.day, 'budget': self.per_day, **self.counts}
+
+class HedgeRace:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.owner = None
+        self.winner = None
+        self.result = None
+        self.errors = {}
+        self.latencies = {}
+        self.abandoned = False
+
+    def claim(self, label):
+        with self.cond:
+            if self.owner is None:
+                self.owner = label
+                self.cond.notify_all()
+            return self.owner == label
+
+    def cancelled(self, label):
+        return self.abandoned or (self.winner is not None and self.winner != label)
+
+    def push(self, label, push):
+        with self.cond:
+            if not self.cancelled(label):
+                push()
+
+    def abandon(self):
+        with self.cond:
+            self.abandoned = True
+            self.cond.notify_all()
+
+    def finish(self, label, result=None, error=None, latency=None):
+        with self.cond:
+            self.latencies[label] = latency
+            if error is not None:
+                self.errors[label] = error
+            elif self.winner is None and not self.abandoned:
+                self.winner = label
+                self.result = result
+            self.cond.notify_all()
+
+class ContextBuilder:
+    def __init__(self, budgets=MODEL_CONTEXT_BUDGETS, default_budget=DEFAULT_CONTEXT_BUDGET, summary_budget=256):
+        self.budgets = budgets
+        self.default_budget = default_budget
+        self.summary_budget = summary_budget
+        self.lock = threading.Lock()
+        self.token_counts = {}
+        self.encoding_lock = threading.Lock()
+        self.encoding = None
+        self.encoding_loaded = False
+
+    def _encoding(self):
+        with self.encoding_lock:
+            if not self.encoding_loaded:
+                self.encoding_loaded = True
+                tiktoken = optional_import('tiktoken')
+                if tiktoken is not None:
+                    try:
+                        self.encoding = tiktoken.get_encoding('cl100k_base')
+                    except Exception as e:
+                        logging.error(f"Error loading tokenizer, falling back to estimates: {e}")
+            return self.encoding
+
+    def count(self, text):
+        encoding = self._encoding()
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        return (len(text) + 3) // 4
+
+    @staticmethod
+    def to_turn(message):
+        if 'user' in message:
+            return {'role': 'user', 'content': message['user']}
+        if 'ai' in message:
+            return {'role': 'assistant', 'content': message['ai']}
+        return None
+
+    def _counts(self, chat_id, messages, end):
+        with self.lock:
+            counts = self.token_counts.setdefault(chat_id, [])
+            for message in messages[len(counts):end]:
+                turn = self.to_turn(message)
+                counts.append(self.count(turn['content']) + MESSAGE_TOKEN_OVERHEAD if turn else 0)
+            return counts[:end]
+
+    def forget(self, chat_id):
+        with self.lock:
+            self.token_counts.pop(chat_id, None)
+
+    def _summarize(self, dropped):
+        lines = []
+        used = 0
+        for message in reversed(dropped):
+            if 'user' not in message:
+                continue
+            line = '- ' + ' '.join(message['user'].split())[:200]
+            cost = self.count(line)
+            if used + cost > self.summary_budget:
+                break
+            lines.append(line)
+            used += cost
+        if not lines:
+            return None
+        return {
+            'role': 'system',
+            'content': f"Earlier in this conversation ({len(dropped)} messages omitted) the user asked:\n" + '\n'.join(reversed(lines)),
+        }
+
+    def build(self, chat_id, messages, end, model):
+        budget = self.budgets.get(model, self.default_budget)
+        counts = self._counts(chat_id, messages, end)
+        start = end - 1
+        used = counts[start]
+        while start > 0 and used + counts[start - 1] <= budget - self.summary_budget:
+            start -= 1
+            used += counts[start]
+        turns = [turn for turn in map(self.to_turn, messages[start:end]) if turn is not None]
+        if start > 0:
+            summary = self._summarize(messages[:start])
+            if summary is not None:
+                turns.insert(0, summary)
+            logging.debug(f"Context for chat {chat_id} trimmed to {end - start} of {end} messages ({used} tokens).")
+        return turns
+
+class Metrics:
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._labels(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._labels(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': {
+                    name: [{'labels': dict(key), 'value': value} for key, value in series.items()]
+                    for name, series in self.counters.items()
+                },
+                'histograms': {
+                    name: [
+                        {
+                            'labels': dict(key),
+                            'count': histogram['count'],
+                            'sum': histogram['sum'],
+                            'buckets': dict(zip(map(str, self.buckets), histogram['buckets'])),
+                        }
+                        for key, histogram in series.items()
+                    ]
+                    for name, series in self.histograms.items()
+                },
+            }
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{self._format_labels(key)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in series.items():
+                    for bound, count in zip(self.buckets, histogram['buckets']):
+                        lines.append(f"{name}_bucket{self._format_labels(key, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{self._format_labels(key, [('le', '+Inf')])} {histogram['count']}")
+                    lines.append(f"{name}_sum{self._format_labels(key)} {histogram['sum']}")
+                    lines.append(f"{name}_count{self._format_labels(key)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        try:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(self.to_prometheus())
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            logging.error(f"Error writing metrics file {path}: {e}")
+
+class Tracer:
+    def __init__(self, metrics, keep=200):
+        self.metrics = metrics
+        self.keep = keep
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.traces = OrderedDict()
+        self.next_id = 0
+
+    def begin(self, request_id, kind, model):
+        with self.lock:
+            if request_id is None:
+                request_id = f"trace-{self.next_id}"
+                self.next_id += 1
+            trace = {'request_id': request_id, 'kind': kind, 'model': model, 'started': time.time(), 'spans': {}}
+            self.traces[request_id] = trace
+            while len(self.traces) > self.keep:
+                self.traces.popitem(last=False)
+        self.local.trace = trace
+        return trace
+
+    def current(self):
+        return getattr(self.local, 'trace', None)
+
+    def record(self, name, duration, trace=None):
+        trace = trace or self.current()
+        if trace is None:
+            return
+        trace['spans'][name] = duration
+        self.metrics.observe('snarkyai_span_seconds', duration, span=name, kind=trace['kind'])
+
+    @contextmanager
+    def span(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start)
+
+    def finish(self, outcome):
+        trace = self.current()
+        if trace is None:
+            return
+        self.local.trace = None
+        trace['outcome'] = outcome
+        trace['duration'] = time.time() - trace['started']
+        self.metrics.inc('snarkyai_generations_total', kind=trace['kind'], outcome=outcome)
+        self.metrics.observe('snarkyai_generation_seconds', trace['duration'], kind=trace['kind'])
+
+    def report(self, request_id, name, duration):
+        with self.lock:
+            trace = self.traces.get(request_id)
+        if trace is not None:
+            self.record(name, duration, trace)
+
+    def get(self, request_id):
+        with self.lock:
+            return self.traces.get(request_id)
+
+    def recent(self, count=20):
+        with self.lock:
+            return list(self.traces.values())[-count:]
+
+class StartupProfile:
+    def __init__(self, start=PROCESS_START):
+        self.start = start
+        self.lock = threading.Lock()
+        self.phases = []
+
+    def record(self, name, began, duration=0.0):
+        with self.lock:
+            self.phases.append((name, began - self.start, duration))
+
+    def mark(self, name):
+        self.record(name, time.perf_counter())
+
+    @contextmanager
+    def phase(self, name):
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, began, time.perf_counter() - began)
+
+    def has(self, *names):
+        with self.lock:
+            recorded = {phase[0] for phase in self.phases}
+        return all(name in recorded for name in names)
+
+    def report(self):
+        with self.lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        lines = [f"{'phase':<20}{'start ms':>12}{'duration ms':>14}"]
+        for name, offset, duration in phases:
+            lines.append(f"{name:<20}{offset * 1000:>12.1f}{duration * 1000:>14.1f}")
+        return '\n'.join(lines)
+
+class ChatRecord:
+    __slots__ = ('id', 'title', 'timestamp', 'messages')
+
+    def __init__(self, id, title, timestamp, messages=None):
+        self.id = id
+        self.title = title
+        self.timestamp = timestamp
+        self.messages = messages
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self):
+        return {'id': self.id, 'title': self.title, 'timestamp': self.timestamp, 'messages': self.messages}
+
+def messages_size(messages):
+    return sys.getsizeof(messages) + sum(
+        sys.getsizeof(message) + sum(sys.getsizeof(value) for value in message.values()) for message in messages
+    )
+
+class ResidentSet:
+    def __init__(self, max_chats=20, max_bytes=None):
+        self.max_chats = max(max_chats, 1)
+        self.max_bytes = max_bytes
+        self.chats = OrderedDict()
+        self.bytes = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def touch(self, chat):
+        entry = self.chats.get(chat.id)
+        if entry is not None:
+            self.chats.move_to_end(chat.id)
+            return
+        size = messages_size(chat.messages)
+        self.chats[chat.id] = [chat, size]
+        self.bytes += size
+        self.loads += 1
+
+    def grow(self, chat_id, message):
+        entry = self.chats.get(chat_id)
+        if entry is not None:
+            size = messages_size([message]) - sys.getsizeof([])
+            entry[1] += size
+            self.bytes += size
+
+    def discard(self, chat_id):
+        entry = self.chats.pop(chat_id, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def _over(self):
+        return len(self.chats) > self.max_chats or (self.max_bytes is not None and self.bytes > self.max_bytes)
+
+    def evict(self, pinned):
+        evicted = []
+        for chat_id in list(self.chats):
+            if not self._over():
+                break
+            if chat_id in pinned:
+                continue
+            chat, size = self.chats.pop(chat_id)
+            chat.messages = None
+            self.bytes -= size
+            self.evictions += 1
+            evicted.append(chat_id)
+        return evicted
+
+    def get_stats(self):
+        return {
+            'resident_chats': len(self.chats),
+            'resident_bytes': self.bytes,
+            'max_chats': self.max_chats,
+            'max_bytes': self.max_bytes,
+            'loads': self.loads,
+            'evictions': self.evictions,
+        }
+
+class Persister:
+    def __init__(self, store, compact, metrics=None, interval=0.5, max_pending=100, on_error=None, archive=None,
+                 retry_delay=1.0, max_retry_delay=60.0):
+        self.store = store
+        self.compact = compact
+        self.archive = archive
+        self.metrics = metrics
+        self.interval = interval
+        self.max_pending = max_pending
+        self.on_error = on_error
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.backoff = retry_delay
+        self.cond = threading.Condition()
+        self.ops = []
+        self.dirty = {}
+        self.versions = {}
+        self.pending_messages = 0
+        self.first_dirty = None
+        self.enqueued = 0
+        self.written = 0
+        self.forced = 0
+        self.flushes = 0
+        self.errors = 0
+        self.failures = 0
+        self.error = None
+        self.retry_at = None
+        self.retry_now = False
+        self.closing = False
+        self.thread = threading.Thread(target=self._run, name='persister', daemon=True)
+        self.thread.start()
+
+    def submit(self, op, chat_id=None, payload=None):
+        with self.cond:
+            if self.first_dirty is None:
+                self.first_dirty = time.monotonic()
+                self.cond.notify_all()
+            self.ops.append((op, chat_id, payload))
+            self.enqueued += 1
+            if chat_id is not None:
+                self.dirty[chat_id] = self.dirty.get(chat_id, 0) + 1
+                self.versions[chat_id] = self.versions.get(chat_id, 0) + 1
+            if op == 'messages':
+                self.pending_messages += len(payload)
+            if op == 'compact' or self.pending_messages >= self.max_pending:
+                self.cond.notify_all()
+
+    def is_dirty(self, chat_id):
+        with self.cond:
+            return chat_id in self.dirty
+
+    def dirty_chats(self):
+        with self.cond:
+            return set(self.dirty)
+
+    def version(self, chat_id):
+        with self.cond:
+            return self.versions.get(chat_id, 0)
+
+    def _flushed(self, target):
+        return self.written >= target and self.error is None
+
+    def flush(self, timeout=10):
+        with self.cond:
+            target = self.enqueued
+            if self._flushed(target):
+                return True
+            failures = self.failures
+            self.forced = max(self.forced, target)
+            self.retry_now = True
+            self.cond.notify_all()
+            self.cond.wait_for(
+                lambda: self._flushed(target) or self.failures > failures or not self.thread.is_alive(), timeout
+            )
+            return self._flushed(target)
+
+    def _due(self):
+        if self.error is not None:
+            return self.closing or self.retry_now or time.monotonic() >= self.retry_at
+        if not self.ops:
+            return False
+        if self.closing or self.forced > self.written or self.pending_messages >= self.max_pending:
+            return True
+        return any(op == 'compact' for op, _, _ in self.ops) or time.monotonic() - self.first_dirty >= self.interval
+
+    def _timeout(self):
+        if self.error is not None:
+            return max(self.retry_at - time.monotonic(), 0)
+        if self.first_dirty is None:
+            return None
+        return self.first_dirty + self.interval - time.monotonic()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self._due():
+                    if self.closing:
+                        return
+                    self.cond.wait(self._timeout())
+                ops, self.ops = self.ops, []
+                self.pending_messages = 0
+                self.first_dirty = None
+                self.retry_now = False
+                closing = self.closing
+            written, error = self._write(ops)
+            with self.cond:
+                self.written += written
+                for _, chat_id, _ in ops[:written]:
+                    if chat_id is not None:
+                        self.dirty[chat_id] -= 1
+                        if not self.dirty[chat_id]:
+                            del self.dirty[chat_id]
+                failed = ops[written:]
+                if failed:
+                    self.ops = failed + self.ops
+                    self.pending_messages += sum(len(payload) for op, _, payload in failed if op == 'messages')
+                    self.first_dirty = time.monotonic()
+                first_error = error is not None and self.error is None
+                if error is None:
+                    self.error = None
+                    self.backoff = self.retry_delay
+                else:
+                    self.error = error
+                    self.failures += 1
+                    self.errors += 1
+                    self.retry_at = time.monotonic() + self.backoff
+                    self.backoff = min(self.backoff * 2, self.max_retry_delay)
+                self.cond.notify_all()
+            if first_error and self.on_error is not None:
+                self.on_error(error)
+            if error is not None and closing:
+                return
+
+    @staticmethod
+    def _batches(ops):
+        index = 0
+        while index < len(ops):
+            op, chat_id, payload = ops[index]
+            end = index + 1
+            if op == 'messages':
+                payload = list(payload)
+                while end < len(ops) and ops[end][0] == 'messages' and ops[end][1] == chat_id:
+                    payload.extend(ops[end][2])
+                    end += 1
+            yield end, op, chat_id, payload
+            index = end
+
+    def _write(self, ops):
+        start = time.monotonic()
+        written = 0
+        try:
+            for end, op, chat_id, payload in self._batches(ops):
+                self._apply(op, chat_id, payload)
+                written = end
+            self.store.sync()
+        except Exception as e:
+            logging.error(f"Error persisting chat history, {len(ops) - written} operations will be retried: {e}")
+            return written, str(e)
+        if self.store.needs_compaction():
+            try:
+                self.compact()
+            except Exception as e:
+                with self.cond:
+                    self.errors += 1
+                logging.error(f"Error compacting chat history, will retry on the next flush: {e}")
+        self.flushes += 1
+        duration = time.monotonic() - start
+        if self.metrics is not None:
+            self.metrics.observe('snarkyai_persist_flush_seconds', duration)
+        logging.debug(f"Persisted {len(ops)} history operations in {duration * 1000:.1f} ms.")
+        return written, None
+
+    def _apply(self, op, chat_id=None, payload=None):
+        if op == 'chat':
+            self.store.append_chat(payload)
+        elif op == 'messages':
+            self.store.append_messages(chat_id, payload)
+        elif op == 'drop':
+            self.store.drop_messages(chat_id)
+        elif op == 'unarchive':
+            self.store.sync()
+            self.archive.remove(chat_id)
+        elif op == 'compact':
+            self.store.sync()
+            self.compact()
+
+    def get_stats(self):
+        with self.cond:
+            return {
+                'pending': len(self.ops),
+                'dirty_chats': len(self.dirty),
+                'flushes': self.flushes,
+                'errors': self.errors,
+                'error': self.error,
+            }
+
+    def close(self, timeout=10):
+        self.flush(timeout)
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+        with self.cond:
+            return self._flushed(self.enqueued)
+
+HISTORY_STORES = {
+    'journal': HistoryJournal,
+    'sqlite': SqliteHistoryStore,
+}
 
 class Api:
-    def __init__(self, history_file='chat_history.json'):
-        self.client = Client()
+    def __init__(self, history_file='chat_history.json', storage='sqlite', max_workers=4, use_cache=False,
+                 metrics_file=None, metrics_interval=15, load_async=False, profile=None, profile_startup=False,
+                 http_pool_size=10, dns_ttl=300, prewarm=False, archive_after_days=0, archive_interval=3600,
+                 resident_chats=20, resident_bytes=None, flush_interval=0.5, flush_messages=100,
+                 hedge=False, hedge_budget=50, deadline=120, backend_url=None, backend_key=None,
+                 fallback_model=AUTO_MODEL):
+        self.profile = profile or StartupProfile(time.perf_counter())
+        self.profile_startup = profile_startup
+        self.startup_reported = False
         self.history_file = os.path.join(os.path.expanduser("~"), 'SnarkyAI', history_file)
         os.makedirs(os.path.dirname(self.history_file), exist_ok=True)
-        self.chat_history = self.load_history()
+        self.store_class = HISTORY_STORES[storage]
+        self.store = None
+        self.lock = threading.RLock()
+        self.metrics = Metrics()
+        self.tracer = Tracer(self.metrics)
+        self.history_error = None
+        self.archive = ChatArchive(os.path.splitext(self.history_file)[0] + '_archive')
+        self.persister = Persister(None, self._compact_history, self.metrics, flush_interval, flush_messages,
+                                   self._history_write_failed, self.archive)
+        self.context = ContextBuilder()
+        self.router = ModelRouter(os.path.join(os.path.dirname(self.history_file), 'model_stats.json'))
+        self.http = HttpSession(pool_size=http_pool_size, dns_ttl=dns_ttl)
+        self.backends = {}
+        if backend_url:
+            self.backends['local'] = OpenAIBackend(backend_url, self.http, backend_key)
+        self.backends['g4f'] = G4FBackend(self.profile)
+        self.model_backends = {}
+        self.fallback_model = fallback_model
+        self.prewarm = prewarm
+        self.images = ImageCache(os.path.join(os.path.dirname(self.history_file), 'images'), self.http)
+        self.cache = ResponseCache(os.path.join(os.path.dirname(self.history_file), 'response_cache.db')) if use_cache else None
+        self.archive_after_days = archive_after_days
+        self.chat_history = []
+        self.chat_index = {}
+        self.next_chat_id = 0
+        self.resident = ResidentSet(resident_chats, resident_bytes)
+        self.history_ready = threading.Event()
         self.current_chat = None
-        self.loading_states = {'text': False, 'image': False}
+        self.current_chat_id = None
+        self.unsaved_messages = {}
+        self.active_generations = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='generation')
+        self.upstream = ThreadPoolExecutor(max_workers=max_workers * 4, thread_name_prefix='upstream')
+        self.hedge_budget = HedgeBudget(hedge_budget) if hedge else None
+        self.generation_deadline = deadline
+        self.cancels = {}
+        self.local = threading.local()
+        self.jobs = {}
+        self.next_request_id = 0
+        self.window = None
+        self.metrics_file = metrics_file
+        self.closed = threading.Event()
+        if metrics_file:
+            threading.Thread(target=self._export_metrics, args=(metrics_interval,), daemon=True).start()
+        if archive_after_days:
+            threading.Thread(target=self._archive_periodically, args=(archive_interval,), daemon=True).start()
+        if not load_async:
+            self.finish_startup(warm_client=False)
 
-    def load_history(self):
-        if os.path.exists(self.history_file):
+    @property
+    def client(self):
+        return self.backends['g4f'].client
+
+    @client.setter
+    def client(self, client):
+        self.backends['g4f'].client = client
+
+    def _backend(self, model):
+        return self.model_backends.get(model) or self.backends['g4f']
+
+    def refresh_models(self):
+        models = {'text': [{'id': AUTO_MODEL, 'label': 'Auto (fastest)', 'backend': None}], 'image': []}
+        model_backends = {}
+        seen = set()
+        for name, backend in self.backends.items():
+            for model in backend.models():
+                if model['id'] in seen:
+                    continue
+                seen.add(model['id'])
+                models[model['kind']].append({'id': model['id'], 'label': model['label'], 'backend': name})
+                if name != 'g4f':
+                    model_backends[model['id']] = backend
+        local = [model for model, backend in model_backends.items() if model not in ROUTE_CANDIDATES]
+        with self.lock:
+            self.model_backends = model_backends
+        with self.router.lock:
+            self.router.fallbacks = {model: self.fallback_model for model in model_backends if model != self.fallback_model}
+            self.router.candidates = local + list(ROUTE_CANDIDATES)
+        return models
+
+    def finish_startup(self, warm_client=True):
+        with self.profile.phase('history_load'):
+            self.store = self.persister.store = self.store_class(self.history_file)
+            self.history_error = getattr(self.store, 'error', None)
+            history = [ChatRecord(chat['id'], chat['title'], chat['timestamp']) for chat in self.load_history()]
+        with self.lock:
+            self.chat_history = history
+            self.chat_index = {chat['id']: chat for chat in history}
+            self.next_chat_id = max((chat['id'] for chat in history), default=-1) + 1
+        self.history_ready.set()
+        if len(self.backends) > 1:
+            self.refresh_models()
+        self._push('onHistoryLoaded', {'total': len(history), 'error': self.history_error or self.persister.error})
+        if warm_client:
             try:
-                with open(self.history_file, 'r', encoding='utf-8') as f:
-                    history = json.load(f)
-                logging.debug(f"Chat history successfully loaded from {self.history_file}.")
-                return history
+                self.client
             except Exception as e:
-                logging.error(f"Error loading chat history: {e}")
-                return []
-        else:
-            logging.debug("Chat history file not found. Creating a new file.")
-            return []
+                logging.error(f"Error importing g4f: {e}")
+        self._report_startup()
 
-    def save_history_to_file(self):
+    def report_startup(self, phase):
+        self.profile.mark(phase)
+        self._report_startup()
+
+    def _report_startup(self):
+        if self.closed.is_set() or not self.profile.has('history_load', 'first_paint', 'g4f_import'):
+            return
+        if self.profile_startup and not self.startup_reported:
+            self.startup_reported = True
+            print(self.profile.report(), flush=True)
+
+    def load_history(self):
         try:
-            absolute_path = os.path.abspath(self.history_file)
-            logging.debug(f"Saving chat history to: {absolute_path}")
-            with open(self.history_file, 'w', encoding='utf-8') as f:
-                json.dump(self.chat_history, f, ensure_ascii=False, indent=4)
-            logging.debug("Chat history successfully saved.")
+            history = self.store.load()
+            logging.debug(f"Chat history successfully loaded ({len(history)} chats).")
+            return history
         except Exception as e:
-            logging.error(f"Error saving chat history: {e}")
+            logging.error(f"Error loading chat history: {e}")
+            self.history_error = str(e)
+            return []
 
-    def generate_text(self, model, prompt):
-        if self.loading_states['text']:
-            logging.debug("Text generation already in progress. Skipping new request.")
-            return "Generation in progress..."
-    
-        self.loading_states['text'] = True
-        try:
+    def _compact_history(self):
+        if self.history_error is not None:
+            logging.error("Skipping compaction because chat history failed to load.")
+            return
+        logging.debug("Compacting chat history.")
+        self.store.compact(list(self.chat_history))
+        logging.debug("Chat history successfully saved.")
+
+    def save_history_to_file(self):
+        self.persister.submit('compact')
+        return self.persister.flush()
+
+    def flush(self):
+        with self.lock:
+            for chat_id in list(self.unsaved_messages):
+                self._commit_messages(chat_id)
+        if not self.persister.flush():
+            error = self.persister.error or 'timed out'
+            logging.error(f"Chat history could not be flushed to disk: {error}")
+            self._push('onHistoryError', {'error': error})
+
+    def _history_write_failed(self, error):
+        log_event('history_write_failed', logging.ERROR, error=error)
+        self._push('onHistoryError', {'error': error})
+
+    def _ensure_chat(self, title=''):
+        self.history_ready.wait()
+        with self.lock:
             if self.current_chat is None:
                 logging.debug("Creating a new chat.")
-                new_chat = {'timestamp': time.time(), 'messages': []}
+                new_chat = ChatRecord(self.next_chat_id, title[:60], time.time(), [])
+                self.next_chat_id += 1
                 self.chat_history.append(new_chat)
+                self.chat_index[new_chat['id']] = new_chat
                 self.current_chat = new_chat['messages']
+                self.current_chat_id = new_chat['id']
+                self.persister.submit('chat', new_chat['id'], {
+                    'id': new_chat['id'], 'title': new_chat['title'], 'timestamp': new_chat['timestamp'],
+                })
+                self._messages(new_chat)
+            return self.chat_index[self.current_chat_id]
 
-            user_message = {'user': prompt}
-            self.current_chat.append(user_message)
-            logging.debug(f"Added user message: {prompt}")
+    def _messages(self, chat):
+        with self.lock:
+            if chat['messages'] is None:
+                if self.archive.contains(chat['id']):
+                    chat['messages'] = self.archive.load(chat['id'])
+                else:
+                    if self.persister.is_dirty(chat['id']):
+                        self.persister.flush()
+                    chat['messages'] = self.store.load_messages(chat['id'])
+            messages = chat['messages']
+            self.resident.touch(chat)
+            pinned = {chat['id'], self.current_chat_id, *self.active_generations, *self.unsaved_messages,
+                      *self.persister.dirty_chats()}
+            for chat_id in self.resident.evict(pinned):
+                self.context.forget(chat_id)
+            return messages
 
-            messages = [{"role": "user", "content": prompt}]
-            response = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                web_search=False
+    def get_memory_stats(self):
+        with self.lock:
+            metadata = sys.getsizeof(self.chat_history) + sys.getsizeof(self.chat_index) + sum(
+                sys.getsizeof(chat) + sys.getsizeof(chat.title) for chat in self.chat_history
             )
-            ai_response = response.choices[0].message.content.strip()
-            ai_message = {'ai': ai_response}
-            self.current_chat.append(ai_message)
-            logging.debug(f"Received AI response: {ai_response}")
+            return json.dumps({'chats': len(self.chat_history), 'metadata_bytes': metadata, **self.resident.get_stats()})
+
+    def _restore_chat(self, chat):
+        with self.lock:
+            messages = self._messages(chat)
+            self.persister.submit('drop', chat['id'])
+            self.persister.submit('messages', chat['id'], list(messages))
+            self.persister.submit('unarchive', chat['id'])
+        log_event('chat_restored', chat_id=chat['id'], messages=len(messages))
+
+    def _archivable(self, chat):
+        return (chat['id'] != self.current_chat_id and chat['id'] not in self.active_generations
+                and chat['id'] not in self.unsaved_messages)
+
+    def _archive_batch(self, chats):
+        with self.lock:
+            chats = [chat for chat in chats if self._archivable(chat)]
+            versions = {chat['id']: self.persister.version(chat['id']) for chat in chats}
+            resident = {chat['id']: list(chat['messages']) for chat in chats if chat['messages'] is not None}
+        if any(self.persister.is_dirty(chat['id']) for chat in chats) and not self.persister.flush():
+            logging.error("Skipping archive batch because chat history could not be flushed.")
+            return 0
+        snapshots = []
+        for chat in chats:
+            messages = resident.get(chat['id'])
+            if messages is None:
+                messages = self.store.load_messages(chat['id'])
+            if messages:
+                snapshots.append({'id': chat['id'], 'title': chat['title'], 'timestamp': chat['timestamp'], 'messages': messages})
+        self.archive.add(snapshots)
+        archived = 0
+        with self.lock:
+            for snapshot in snapshots:
+                chat = self.chat_index[snapshot['id']]
+                if not self._archivable(chat) or self.persister.version(chat['id']) != versions[chat['id']]:
+                    self.archive.remove(chat['id'])
+                    continue
+                self.persister.submit('drop', chat['id'])
+                chat['messages'] = None
+                self.resident.discard(chat['id'])
+                self.context.forget(chat['id'])
+                archived += 1
+        return archived
+
+    def archive_old_chats(self, batch_size=100):
+        cutoff = time.time() - self.archive_after_days * 86400
+        with self.lock:
+            candidates = [
+                chat for chat in self.chat_history
+                if chat['timestamp'] < cutoff and not self.archive.contains(chat['id'])
+            ]
+        if not candidates:
+            return self.archive.get_stats()
+        start = time.monotonic()
+        archived = 0
+        for index in range(0, len(candidates), batch_size):
+            if self.closed.is_set():
+                break
+            archived += self._archive_batch(candidates[index:index + batch_size])
+        self.archive.compact()
+        stats = self.archive.get_stats()
+        log_event('chats_archived', archived=archived, duration_ms=round((time.monotonic() - start) * 1000), **stats)
+        return stats
+
+    def _archive_periodically(self, interval):
+        self.history_ready.wait()
+        while not self.closed.is_set():
+            try:
+                self.archive_old_chats()
+            except Exception as e:
+                logging.error(f"Error archiving old chats: {e}")
+            if self.closed.wait(interval):
+                break
+
+    def _append_message(self, chat, message):
+        with self.lock:
+            self._messages(chat).append(message)
+            self.resident.grow(chat['id'], message)
+            self.unsaved_messages.setdefault(chat['id'], []).append(message)
+
+    def _commit_messages(self, chat_id):
+        with self.lock:
+            messages = self.unsaved_messages.pop(chat_id, None)
+            if not messages:
+                return
+            self.persister.submit('messages', chat_id, messages)
+
+    def _push(self, function, payload):
+        if self.window is None:
+            return
+        try:
+            self.window.evaluate_js(f"{function}({json.dumps(payload)})")
+        except Exception as e:
+            logging.error(f"Error pushing {function} to the page: {e}")
 
-            self.save_history_to_file()
+    def _first_byte(self, model, latency, race=None, label=None):
+        self.router.record_first_byte(model, latency)
+        if race is None or race.claim(label):
+            self.tracer.record('first_byte', latency)
+            return True
+        return False
 
+    def _push_chunk(self, stream_id, text, race=None, label=None):
+        if race is None:
+            self._push('onTextChunk', {'stream_id': stream_id, 'text': text})
+        else:
+            race.push(label, lambda: self._push('onTextChunk', {'stream_id': stream_id, 'text': text}))
+
+    def _stream_completion(self, model, messages, stream_id, timeout=None, race=None, label=None):
+        chunks = []
+        pending = []
+        last_push = 0
+        owner = False
+        token = getattr(self.local, 'cancel', None)
+        start = time.monotonic()
+        response = self._backend(model).stream(model, messages, timeout, token)
+        for delta in response:
+            if race is not None and race.cancelled(label):
+                response.close()
+                return None
+            if token is not None and token.cancelled():
+                response.close()
+                raise GenerationCancelled(token.reason, ''.join(chunks).strip())
+            if not chunks:
+                owner = self._first_byte(model, time.monotonic() - start, race, label)
+                if owner and token is not None:
+                    token.chunks = chunks
+            chunks.append(delta)
+            pending.append(delta)
+            now = time.monotonic()
+            if owner and now - last_push >= STREAM_PUSH_INTERVAL:
+                self._push_chunk(stream_id, ''.join(pending), race, label)
+                pending = []
+                last_push = now
+        if owner and pending:
+            self._push_chunk(stream_id, ''.join(pending), race, label)
+        return ''.join(chunks)
+
+    def _start_generation(self, prompt):
+        chat = self._ensure_chat(prompt)
+        with self.lock:
+            if self.archive.contains(chat['id']):
+                self._restore_chat(chat)
+            self.active_generations[chat['id']] = self.active_generations.get(chat['id'], 0) + 1
+        with self.lock:
+            self._append_message(chat, {'user': prompt})
+            turn = len(chat['messages'])
+        log_event('user_message', logging.DEBUG, chat_id=chat['id'], turn=turn, prompt=prompt)
+        return chat, turn
+
+    def _finish_generation(self, chat):
+        with self.lock:
+            self.active_generations[chat['id']] -= 1
+            if not self.active_generations[chat['id']]:
+                del self.active_generations[chat['id']]
+                self._commit_messages(chat['id'])
+
+    def _upstream(self, fn, *args, **kwargs):
+        token = getattr(self.local, 'cancel', None)
+        if token is None or getattr(self.local, 'upstream', False):
+            return fn(*args, **kwargs)
+        token.check()
+        return token.wait(self.upstream.submit(self._in_upstream, self.tracer.current(), token, fn, *args, **kwargs))
+
+    def _in_upstream(self, trace, token, fn, *args, **kwargs):
+        self.tracer.local.trace = trace
+        self.local.cancel = token
+        self.local.upstream = True
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.tracer.local.trace = None
+            self.local.cancel = None
+            self.local.upstream = False
+
+    def _complete_with(self, model, messages, stream_id=None, timeout=None, race=None, label=None):
+        if stream_id is not None:
+            text = self._upstream(self._stream_completion, model, messages, stream_id, timeout, race, label)
+            if text is None and race is not None and race.cancelled(label):
+                return None
+        else:
+            start = time.monotonic()
+            text = self._upstream(self._backend(model).complete, model, messages, timeout,
+                                  getattr(self.local, 'cancel', None))
+            self._first_byte(model, time.monotonic() - start, race, label)
+        if text is None:
+            raise RuntimeError(f"{model} returned no response")
+        return text.strip()
+
+    def _race(self, race, label, model, messages, stream_id, timeout):
+        start = time.monotonic()
+        try:
+            result = self._complete_with(model, messages, stream_id, timeout, race, label)
+        except Exception as e:
+            race.finish(label, error=e)
+            return
+        race.finish(label, result, latency=time.monotonic() - start)
+
+    def _hedged_complete(self, model, messages, stream_id=None, timeout=None):
+        delay = self.router.first_byte_p90(model)
+        alternate = self.router.alternate(model)
+        if delay is None or alternate is None:
+            return self._complete_with(model, messages, stream_id, timeout), None
+        start = time.monotonic()
+        deadline = start + (timeout or self.router.deadline)
+        race = HedgeRace()
+        trace = self.tracer.current()
+        token = getattr(self.local, 'cancel', None)
+        if token is not None:
+            token.on_cancel(race.abandon)
+        self.upstream.submit(self._in_upstream, trace, token, self._race, race, 'primary', model, messages, stream_id, timeout)
+        with race.cond:
+            race.cond.wait_for(lambda: race.owner or race.winner or race.errors or race.abandoned, delay)
+            hedged = (race.owner is None and race.winner is None and not race.errors and not race.abandoned
+                      and self.hedge_budget.take())
+        if hedged:
+            log_event('hedge_fired', model=model, alternate=alternate, after_ms=round(delay * 1000))
+            self.metrics.inc('snarkyai_hedges_total', model=model, outcome='fired')
+            self.upstream.submit(self._in_upstream, trace, token, self._race, race, 'hedge', alternate, messages,
+                                 stream_id, max(deadline - time.monotonic(), 0.1))
+        attempts = 2 if hedged else 1
+        with race.cond:
+            finished = race.cond.wait_for(lambda: race.winner or len(race.errors) >= attempts or race.abandoned,
+                                          max(deadline - time.monotonic(), 0))
+            if not finished:
+                race.abandoned = True
+            elif race.winner is not None and race.winner != race.owner and stream_id is not None:
+                self._push('onTextChunk', {'stream_id': stream_id, 'text': race.result, 'reset': True})
+            winner, result, latency = race.winner, race.result, race.latencies.get(race.winner)
+        if hedged:
+            won = winner == 'hedge'
+            self.hedge_budget.settle(won)
+            self.metrics.inc('snarkyai_hedges_total', model=model, outcome='won' if won else 'wasted')
+            log_event('hedge_finished', model=model, alternate=alternate, winner=winner or 'none',
+                      **self.hedge_budget.get_stats())
+        if token is not None:
+            token.check()
+        if winner is None:
+            if not finished:
+                raise TimeoutError(f"{model} did not answer within {timeout or self.router.deadline:.0f}s")
+            raise race.errors['primary']
+        if winner == 'hedge':
+            return result, {alternate: latency, model: time.monotonic() - start}
+        return result, None
+
+    def _complete(self, model, messages, stream_id=None):
+        def on_failover(candidate):
+            logging.debug(f"Retrying with {candidate}.")
+            if stream_id is not None:
+                self._push('onTextChunk', {'stream_id': stream_id, 'text': '', 'reset': True})
+
+        def attempt(candidate, timeout):
+            token = getattr(self.local, 'cancel', None)
+            if token is not None and token.remaining() is not None:
+                timeout = min(timeout, token.remaining())
+            if self.hedge_budget is not None:
+                return self._hedged_complete(candidate, messages, stream_id, timeout)
+            return self._complete_with(candidate, messages, stream_id, timeout), None
+
+        return self.router.run(model, attempt, on_failover)
+
+    def _text_response(self, model, messages, stream_id=None, bypass_cache=False):
+        with self.tracer.span('upstream'):
+            if self.cache is not None:
+                key = ResponseCache.make_key(model, messages, {'web_search': False})
+                token = getattr(self.local, 'cancel', None)
+                return self.cache.get_or_compute(
+                    key, lambda: self._complete(model, messages, stream_id), bypass=bypass_cache,
+                    wait=token.wait if token is not None else None
+                )
+            return self._complete(model, messages, stream_id)
+
+    def _image_response(self, model, prompt):
+        with self.tracer.span('upstream'):
+            url = self._upstream(self._backend(model).generate_image, model, prompt, getattr(self.local, 'cancel', None))
+        return url.strip()
+
+    def _generate(self, kind, chat, model, prompt, stream_id=None, bypass_cache=False, turn=None, compare=None):
+        if kind == 'text':
+            if turn is None:
+                messages = [{"role": "user", "content": prompt}]
+            else:
+                with self.lock:
+                    messages = self.context.build(chat['id'], self._messages(chat), turn, model)
+            start = time.monotonic()
+            truncated = None
+            try:
+                ai_response = self._text_response(model, messages, stream_id, bypass_cache)
+            except GenerationCancelled as e:
+                if not e.partial:
+                    raise
+                ai_response, truncated = e.partial, e
+            message = {'ai': ai_response}
+            if truncated is not None:
+                message['truncated'] = True
+            if compare is not None:
+                message.update({'model': model, 'compare': compare, 'latency_ms': round((time.monotonic() - start) * 1000)})
+            self._append_message(chat, message)
+            log_event('text_response', logging.DEBUG, chat_id=chat['id'], model=model, response=ai_response,
+                      duration_ms=round((time.monotonic() - start) * 1000), truncated=truncated is not None)
+            if truncated is not None:
+                raise truncated
             return ai_response
+
+        image_url = self._image_response(model, prompt)
+        self.images.prefetch(image_url)
+        self._append_message(chat, {'image': image_url})
+        log_event('image_response', logging.DEBUG, chat_id=chat['id'], model=model, url_chars=len(image_url))
+        return image_url
+
+    def _cancel_token(self, request_id=None):
+        token = CancelToken(self.generation_deadline)
+        if request_id is not None:
+            with self.lock:
+                self.cancels[request_id] = token
+        return token
+
+    def _begin_cancellable(self, token):
+        token.arm()
+        self.local.cancel = token
+        token.check()
+
+    def _end_cancellable(self, request_id=None):
+        self.local.cancel = None
+        if request_id is not None:
+            with self.lock:
+                self.cancels.pop(request_id, None)
+
+    def _cancelled_result(self, e):
+        if e.partial:
+            return e.partial
+        if e.reason == 'deadline':
+            return f"Error: Generation timed out after {self.generation_deadline:g}s"
+        return "Error: Generation cancelled"
+
+    @contextmanager
+    def _generation(self, kind, model, request_id=None, prompt=None, chat=None, token=None):
+        generation = {'chat': chat, 'turn': None}
+        outcome = 'error'
+        try:
+            self.tracer.begin(request_id, kind, model)
+            if token is None:
+                token = self._cancel_token(request_id)
+            if prompt is not None:
+                generation['chat'], generation['turn'] = self._start_generation(prompt)
+            self._begin_cancellable(token)
+            yield generation
+            outcome = 'done'
+        except GenerationCancelled as e:
+            outcome = e.outcome
+            raise
+        finally:
+            self._end_cancellable(request_id)
+            if generation['chat'] is not None:
+                self._finish_generation(generation['chat'])
+            self.tracer.finish(outcome)
+
+    def generate_text(self, model, prompt, stream_id=None, bypass_cache=False):
+        try:
+            with self._generation('text', model, stream_id, prompt) as generation:
+                return self._generate('text', generation['chat'], model, prompt, stream_id, bypass_cache,
+                                      generation['turn'])
+        except GenerationCancelled as e:
+            return self._cancelled_result(e)
         except Exception as e:
             logging.error(f"Error generating text: {e}")
             return f"Error: {str(e)}"
-        finally:
-            self.loading_states['text'] = False
 
     def generate_image(self, model, prompt):
-        if self.loading_states['image']:
-            logging.debug("Image generation already in progress. Skipping new request.")
-            return "Generation in progress..."
-    
-        self.loading_states['image'] = True
         try:
-            if self.current_chat is None:
-                logging.debug("Creating a new chat.")
-                new_chat = {'timestamp': time.time(), 'messages': []}
-                self.chat_history.append(new_chat)
-                self.current_chat = new_chat['messages']
+            with self._generation('image', model, prompt=prompt) as generation:
+                return self._generate('image', generation['chat'], model, prompt)
+        except GenerationCancelled as e:
+            return self._cancelled_result(e)
+        except Exception as e:
+            logging.error(f"Error generating image: {e}")
+            return f"Error: {str(e)}"
 
-            user_message = {'user': prompt}
-            self.current_chat.append(user_message)
-            logging.debug(f"Added user message: {prompt}")
+    def run_prompt(self, kind, model, prompt, request_id=None, bypass_cache=False):
+        if kind not in ('text', 'image'):
+            raise ValueError(f"Unknown generation kind: {kind}")
+        with self._generation(kind, model, request_id):
+            if kind == 'text':
+                return self._text_response(model, [{"role": "user", "content": prompt}], bypass_cache=bypass_cache)
+            return self._image_response(model, prompt)
 
-            response = self.client.images.generate(
-                model=model,
-                prompt=prompt,
-                response_format="url"
-            )
-            image_url = response.data[0].url.strip()
-            image_message = {'image': image_url}
-            self.current_chat.append(image_message)
-            logging.debug(f"Received image: {image_url}")
+    def submit_generation(self, kind, model, prompt, request_id=None, bypass_cache=False):
+        if kind not in ('text', 'image'):
+            return json.dumps({'error': f"Unknown generation kind: {kind}"})
+        chat, turn = self._start_generation(prompt)
+        with self.lock:
+            if request_id is None or request_id in self.jobs:
+                request_id = f"request-{self.next_request_id}"
+                self.next_request_id += 1
+            job = {
+                'request_id': request_id,
+                'chat_id': chat['id'],
+                'kind': kind,
+                'model': model,
+                'bypass_cache': bypass_cache,
+                'turn': turn,
+                'state': 'queued',
+                'submitted': time.time(),
+            }
+            self.jobs[request_id] = job
+            self.cancels[request_id] = CancelToken(self.generation_deadline)
+        log_event('generation_queued', logging.DEBUG, request_id=request_id, kind=kind, model=model, chat_id=chat['id'])
+        self.executor.submit(self._run_job, job, chat, prompt)
+        return json.dumps({'request_id': request_id, 'chat_id': chat['id']})
 
-            self.save_history_to_file()
+    def compare(self, models, prompt, request_id=None, bypass_cache=False):
+        models = [model for model in dict.fromkeys(models) if model]
+        if not models:
+            return json.dumps({'error': "No models to compare"})
+        chat, turn = self._start_generation(prompt)
+        with self.lock:
+            self.active_generations[chat['id']] += len(models) - 1
+            if request_id is None or any(f"{request_id}:{model}" in self.jobs for model in models):
+                request_id = f"compare-{self.next_request_id}"
+                self.next_request_id += 1
+            jobs = []
+            for model in models:
+                job = {
+                    'request_id': f"{request_id}:{model}",
+                    'compare_id': request_id,
+                    'chat_id': chat['id'],
+                    'kind': 'text',
+                    'model': model,
+                    'bypass_cache': bypass_cache,
+                    'turn': turn,
+                    'state': 'queued',
+                    'submitted': time.time(),
+                }
+                self.jobs[job['request_id']] = job
+                self.cancels[job['request_id']] = CancelToken(self.generation_deadline)
+                jobs.append(job)
+        logging.debug(f"Comparing {len(models)} models as {request_id} for chat {chat['id']}.")
+        for job in jobs:
+            self.executor.submit(self._run_job, job, chat, prompt)
+        return json.dumps({
+            'request_id': request_id,
+            'chat_id': chat['id'],
+            'jobs': [{'request_id': job['request_id'], 'model': job['model']} for job in jobs],
+        })
 
-            return image_url
+    def _run_job(self, job, chat, prompt):
+        job['state'] = 'running'
+        job['started'] = time.time()
+        with self.lock:
+            token = self.cancels.get(job['request_id']) or CancelToken(self.generation_deadline)
+        try:
+            with self._generation(job['kind'], job['model'], job['request_id'], chat=chat, token=token):
+                stream_id = job['request_id'] if job['kind'] == 'text' else None
+                result = self._generate(
+                    job['kind'], chat, job['model'], prompt, stream_id, job['bypass_cache'], job['turn'],
+                    job.get('compare_id')
+                )
+            job['state'] = 'done'
+        except GenerationCancelled as e:
+            result = self._cancelled_result(e)
+            job['state'] = e.outcome
+            job['truncated'] = bool(e.partial)
         except Exception as e:
-            logging.error(f"Error generating image: {e}")
-            return f"Error: {str(e)}"
+            logging.error(f"Error in {job['kind']} generation {job['request_id']}: {e}")
+            result = f"Error: {str(e)}"
+            job['state'] = 'error'
         finally:
-            self.loading_states['image'] = False
+            job['finished'] = time.time()
+            job['latency_ms'] = round((job['finished'] - job['started']) * 1000)
+            self.tracer.report(job['request_id'], 'queue', job['started'] - job['submitted'])
+            with self.lock:
+                self.jobs.pop(job['request_id'], None)
+            log_event('generation_finished', request_id=job['request_id'], kind=job['kind'], model=job['model'],
+                      state=job['state'], latency_ms=job['latency_ms'],
+                      queue_ms=round((job['started'] - job['submitted']) * 1000))
+        self._push('onGenerationDone', {**job, 'result': result})
+
+    def cancel(self, request_id):
+        with self.lock:
+            tokens = [
+                (key, token) for key, token in self.cancels.items()
+                if key == request_id or self.jobs.get(key, {}).get('compare_id') == request_id
+            ]
+        cancelled = [key for key, token in tokens if token.cancel()]
+        log_event('generation_cancel_requested', request_id=request_id, cancelled=len(cancelled))
+        return json.dumps({'cancelled': cancelled})
+
+    def get_generations(self, chat_id=None):
+        with self.lock:
+            jobs = [dict(job) for job in self.jobs.values() if chat_id is None or job['chat_id'] == chat_id]
+        return json.dumps(jobs)
+
+    def warm_up(self, model):
+        if not self.prewarm:
+            return json.dumps({'warming': []})
+        backends = [self._backend(candidate) for candidate in self.router.route(model)[:2]]
+        urls = [url for backend in backends if getattr(backend, 'session', None) is self.http
+                for url in backend.urls(model)]
+        return json.dumps({'warming': self.http.warm(urls)})
+
+    def get_models(self):
+        try:
+            models = self.refresh_models()
+        except Exception as e:
+            logging.error(f"Error listing models: {e}")
+            return json.dumps({'error': str(e)})
+        return json.dumps({**models, 'compare_defaults': COMPARE_DEFAULTS})
+
+    def get_image(self, url, size='thumb'):
+        try:
+            return self.images.get(url, size)
+        except Exception as e:
+            logging.error(f"Error loading cached image {describe_url(url)}: {e}")
+            return f"Error: {str(e)}"
+
+    def report_render(self, request_id, duration_ms):
+        self.tracer.report(request_id, 'render', duration_ms / 1000)
+
+    def get_trace(self, request_id):
+        return json.dumps(self.tracer.get(request_id))
+
+    def get_metrics(self):
+        return json.dumps({**self.metrics.snapshot(), 'traces': self.tracer.recent()})
+
+    def _export_metrics(self, interval):
+        while not self.closed.wait(interval):
+            self.metrics.write_prometheus(self.metrics_file)
+
+    def get_model_stats(self):
+        return json.dumps(self.router.get_stats())
+
+    def get_cache_stats(self):
+        if self.cache is None:
+            return json.dumps({'enabled': False})
+        return json.dumps({'enabled': True, **self.cache.get_stats()})
+
+    def get_archive_stats(self):
+        return json.dumps(self.archive.get_stats())
 
     def get_history(self):
-        return json.dumps(self.chat_history)
+        return json.dumps([{**chat.to_dict(), 'messages': self._messages(chat)} for chat in self.chat_history])
 
     def save_chat(self):
         if self.current_chat:
-            logging.debug("Saving current chat.")
-            self.save_history_to_file()
+            logging.debug("Current chat is already persisted.")
             self.current_chat = None
+            self.current_chat_id = None
             logging.debug("Current chat cleared for a new session.")
         else:
             logging.debug("No active chat to save.")
 
-    def load_chat(self, messages):
-        if messages:
-            logging.debug("Loading selected chat.")
-            self.current_chat = messages
-            self.save_history_to_file()
-            logging.debug("Selected chat loaded and saved.")
+    def list_chats(self, offset=0, limit=50):
+        total = len(self.chat_history)
+        end = max(total - offset, 0)
+        page = self.chat_history[max(end - limit, 0):end]
+        return json.dumps({
+            'loading': not self.history_ready.is_set(),
+            'total': total,
+            'chats': [{'id': chat['id'], 'title': chat['title'], 'timestamp': chat['timestamp'],
+                       'archived': self.archive.contains(chat['id'])} for chat in reversed(page)],
+        })
+
+    def search_history(self, query, limit=20):
+        start = time.monotonic()
+        self.history_ready.wait()
+        self.persister.flush()
+        try:
+            results = self.store.search(query, limit)
+        except Exception as e:
+            logging.error(f"Error searching chat history: {e}")
+            return json.dumps({'error': str(e), 'results': []})
+        self.metrics.observe('snarkyai_search_seconds', time.monotonic() - start)
+        return json.dumps({'query': query, 'results': results})
+
+    def open_chat(self, chat_id, limit=50, around=None):
+        chat = self.chat_index.get(chat_id)
+        if chat is None:
+            logging.error(f"Chat {chat_id} not found.")
+            return json.dumps({'error': f"Chat {chat_id} not found"})
+        logging.debug(f"Opening chat {chat_id}.")
+        with self.lock:
+            self.current_chat = self._messages(chat)
+            self.current_chat_id = chat_id
+            pending = [{'request_id': job['request_id'], 'kind': job['kind'], 'model': job['model'],
+                        'compare_id': job.get('compare_id')}
+                       for job in self.jobs.values() if job['chat_id'] == chat_id]
+        before = None if around is None else around + limit // 2
+        page = json.loads(self.get_messages(chat_id, before, limit))
+        page['pending'] = pending
+        return json.dumps(page)
+
+    def get_messages(self, chat_id, before=None, limit=50):
+        chat = self.chat_index.get(chat_id)
+        if chat is None:
+            return json.dumps({'error': f"Chat {chat_id} not found"})
+        with self.lock:
+            messages = self._messages(chat)
+            end = len(messages) if before is None else max(min(before, len(messages)), 0)
+            start = max(end - limit, 0)
+            return json.dumps({
+                'id': chat_id,
+                'title': chat['title'],
+                'timestamp': chat['timestamp'],
+                'total': len(messages),
+                'start': start,
+                'messages': messages[start:end],
+            })
+
+    def load_chat(self, messages, chat_id=None):
+        chat = self.chat_index.get(chat_id)
+        if chat is not None:
+            logging.debug(f"Loading chat {chat_id}.")
+            self.current_chat = self._messages(chat)
+            self.current_chat_id = chat_id
+        elif messages:
+            logging.debug("Loading selected chat as a new stored chat.")
+            self.current_chat = None
+            chat = self._ensure_chat(chat_title(messages))
+            for message in messages:
+                self._append_message(chat, message)
+            self._commit_messages(chat['id'])
         else:
             logging.debug("No messages to load.")
             self.current_chat = None
+            self.current_chat_id = None
+
+    def close(self):
+        self.closed.set()
+        if self.metrics_file:
+            self.metrics.write_prometheus(self.metrics_file)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            tokens = list(self.cancels.values())
+        for token in tokens:
+            token.cancel('closed')
+        self.upstream.shutdown(wait=False, cancel_futures=True)
+        self.flush()
+        if not self.persister.close():
+            logging.error(f"Closing with unsaved chat history: {self.persister.error or 'timed out'}")
+        if self.store is not None:
+            self.store.close()
+        if self.cache is not None:
+            self.cache.close()
+        self.images.close()
+        self.archive.close()
+        self.http.close()
+        self.router.save()
 
     def open_url(self, url):
         try:
             webbrowser.open(url)
-            logging.debug(f"Opened URL in browser: {url}")
+            logging.debug(f"Opened URL in browser: {describe_url(url)}")
+        except Exception as e:
+            logging.error(f"Failed to open URL {describe_url(url)}: {e}")
+
+class BatchRunner:
+    def __init__(self, api, output, workers=8, model_limit=2, model_limits=None):
+        self.api = api
+        self.output = output
+        self.workers = workers
+        self.model_limit = model_limit
+        self.model_limits = model_limits or {}
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.running = {}
+        self.results = []
+        self.output_error = None
+
+    @staticmethod
+    def read_tasks(lines, models, done=()):
+        tasks = []
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = line
+            if not isinstance(record, dict):
+                record = {'prompt': str(record)}
+            error = None
+            if not isinstance(record.get('prompt'), str):
+                error = f"line {number}: missing 'prompt'"
+                logging.error(f"Skipping batch input {error}.")
+            for model in ([record['model']] if record.get('model') else models):
+                task = {
+                    'id': f"{record.get('id', number)}:{model}",
+                    'kind': record.get('kind', 'text'),
+                    'model': model,
+                    'prompt': record.get('prompt'),
+                }
+                if error is not None:
+                    task['error'] = error
+                if task['id'] not in done:
+                    tasks.append(task)
+        return tasks
+
+    @staticmethod
+    def completed_ids(path):
+        done = set()
+        if not path or not os.path.exists(path):
+            return done
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if result.get('status') == 'ok':
+                    done.add(result['id'])
+        return done
+
+    def limit(self, model):
+        return self.model_limits.get(model, self.model_limit)
+
+    def _next_task(self, queues):
+        if sum(self.running.values()) >= self.workers:
+            return None
+        for model, pending in queues.items():
+            if pending and self.running.get(model, 0) < self.limit(model):
+                return pending.popleft()
+        return None
+
+    def run(self, tasks):
+        queues = OrderedDict()
+        for task in tasks:
+            queues.setdefault(task['model'], deque()).append(task)
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='batch') as pool:
+            with self.condition:
+                while any(queues.values()) and self.output_error is None:
+                    task = self._next_task(queues)
+                    if task is None:
+                        self.condition.wait()
+                        continue
+                    self.running[task['model']] = self.running.get(task['model'], 0) + 1
+                    pool.submit(self._run_task, task)
+        if self.output_error is not None:
+            raise self.output_error
+        return self.summary(time.monotonic() - start)
+
+    def _run_task(self, task):
+        started = time.monotonic()
+        result = {'id': task['id'], 'kind': task['kind'], 'model': task['model'], 'prompt': task['prompt']}
+        try:
+            if 'error' in task:
+                raise ValueError(task['error'])
+            result['result'] = self.api.run_prompt(task['kind'], task['model'], task['prompt'], f"batch-{task['id']}")
+            result['status'] = 'ok'
+        except Exception as e:
+            logging.error(f"Error in batch prompt {task['id']}: {e}")
+            result['error'] = str(e)
+            result['status'] = 'error'
+        result['latency_ms'] = round((time.monotonic() - started) * 1000, 1)
+        try:
+            with self.write_lock:
+                self.output.write(json.dumps(result) + '\n')
+                self.output.flush()
+                self.results.append(result)
         except Exception as e:
-            logging.error(f"Failed to open URL {url}: {e}")
+            logging.error(f"Error writing batch result {task['id']}, stopping the batch: {e}")
+            with self.condition:
+                if self.output_error is None:
+                    self.output_error = e
+        finally:
+            with self.condition:
+                self.running[task['model']] -= 1
+                self.condition.notify()
+
+    def summary(self, elapsed):
+        def stats(results):
+            latencies = sorted(result['latency_ms'] for result in results)
+            if not latencies:
+                return {'count': 0}
+            return {
+                'count': len(latencies),
+                'errors': sum(1 for result in results if result['status'] != 'ok'),
+                'mean_ms': round(sum(latencies) / len(latencies), 1),
+                'p50_ms': latencies[int(len(latencies) * 0.50)],
+                'p95_ms': latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)],
+                'p99_ms': latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)],
+            }
+
+        by_model = {}
+        for result in self.results:
+            by_model.setdefault(result['model'], []).append(result)
+        return {
+            'elapsed_s': round(elapsed, 2),
+            'throughput_per_s': round(len(self.results) / elapsed, 2) if elapsed else None,
+            **stats(self.results),
+            'models': {model: stats(results) for model, results in by_model.items()},
+        }
 
 html = """
 <!DOCTYPE html>
@@ -255,11 +3348,22 @@ html = """
         .messages {
             flex: 1;
             overflow-y: auto;
+            overflow-anchor: none;
             padding: 20px;
+            margin-bottom: 80px;
+        }
+
+        .message-row {
             display: flex;
             flex-direction: column;
-            gap: 20px;
-            margin-bottom: 80px;
+            padding-bottom: 20px;
+        }
+
+        .message-row.restored .message,
+        .message-row.restored .message-image {
+            animation: none;
+            opacity: 1;
+            transform: none;
         }
 
         .message {
@@ -289,6 +3393,34 @@ html = """
             border-bottom-left-radius: 5px;
         }
 
+        .message.streaming {
+            white-space: pre-wrap;
+            animation: none;
+        }
+
+        .message.plain {
+            white-space: pre-wrap;
+        }
+
+        .message.streaming.rendered {
+            white-space: normal;
+        }
+
+        .message.truncated::after {
+            content: ' [stopped]';
+            font-style: italic;
+            opacity: 0.6;
+        }
+
+        #stop-btn {
+            display: none;
+            background: #ff4d4d;
+        }
+
+        #stop-btn.active {
+            display: flex;
+        }
+
         .message.error {
             align-self: center;
             background: #ff4d4d;
@@ -311,6 +3443,33 @@ html = """
             transform: scale(1.02);
         }
 
+        .message-image.loading {
+            min-width: 200px;
+            min-height: 200px;
+            background: rgba(255, 255, 255, 0.05);
+        }
+
+        .image-viewer {
+            position: fixed;
+            inset: 0;
+            background: rgba(0, 0, 0, 0.85);
+            display: none;
+            align-items: center;
+            justify-content: center;
+            z-index: 1003;
+        }
+
+        .image-viewer.active {
+            display: flex;
+        }
+
+        .image-viewer img {
+            max-width: 90%;
+            max-height: 90%;
+            border-radius: 15px;
+            cursor: pointer;
+        }
+
         .input-container {
             position: fixed;
             bottom: 0;
@@ -379,6 +3538,15 @@ html = """
             transform: scale(0.95);
         }
 
+        .cache-toggle {
+            display: none;
+            align-items: center;
+            gap: 6px;
+            font-size: 12px;
+            opacity: 0.8;
+            cursor: pointer;
+        }
+
         .model-selector {
             position: relative;
             display: inline-block;
@@ -429,8 +3597,45 @@ html = """
             color: var(--text);
         }
 
-        .model-option:hover {
-            background: rgba(255,255,255,0.05);
+        .model-option:hover {
+            background: rgba(255,255,255,0.05);
+        }
+
+        .compare-options {
+            border-top: 1px solid rgba(255,255,255,0.1);
+            margin-top: 8px;
+            padding: 8px 16px 0;
+            font-size: 12px;
+            opacity: 0.8;
+        }
+
+        .compare-options label {
+            display: block;
+            padding: 4px 0;
+            cursor: pointer;
+        }
+
+        .compare-group {
+            display: flex;
+            gap: 12px;
+            align-items: flex-start;
+        }
+
+        .compare-column {
+            flex: 1;
+            min-width: 0;
+            display: flex;
+            flex-direction: column;
+        }
+
+        .compare-column .message {
+            max-width: 100%;
+        }
+
+        .compare-header {
+            font-size: 12px;
+            opacity: 0.7;
+            margin: 0 0 6px 8px;
         }
 
         .loader {
@@ -501,6 +3706,32 @@ html = """
             transform: translateX(5px);
         }
 
+        .history-search {
+            width: 100%;
+            box-sizing: border-box;
+            padding: 10px 12px;
+            margin-bottom: 8px;
+            border: none;
+            border-radius: 8px;
+            background: var(--highlight);
+            color: var(--text);
+        }
+
+        .search-snippet {
+            font-size: 0.85em;
+            opacity: 0.8;
+            margin-top: 4px;
+        }
+
+        .search-snippet mark {
+            background: rgba(255, 215, 0, 0.35);
+            color: inherit;
+        }
+
+        .message-row.search-hit .message {
+            box-shadow: 0 0 0 2px rgba(255, 215, 0, 0.6);
+        }
+
         .notification {
             position: fixed;
             bottom: 20px;
@@ -531,10 +3762,123 @@ html = """
             font-family: 'Courier New', Courier, monospace;
         }
 
+        .markdown :not(pre) > code {
+            background: #2c2c2c;
+            padding: 1px 5px;
+            border-radius: 4px;
+        }
+
         .code-container {
             position: relative;
         }
 
+        .code-lang {
+            position: absolute;
+            top: 6px;
+            right: 55px;
+            font-size: 10px;
+            opacity: 0.6;
+            text-transform: lowercase;
+        }
+
+        .tok-kw {
+            color: #c792ea;
+        }
+
+        .tok-str {
+            color: #c3e88d;
+        }
+
+        .tok-num {
+            color: #f78c6c;
+        }
+
+        .tok-com {
+            color: #7f8c98;
+            font-style: italic;
+        }
+
+        .markdown > :first-child {
+            margin-top: 0;
+        }
+
+        .markdown > :last-child {
+            margin-bottom: 0;
+        }
+
+        .markdown p,
+        .markdown ul,
+        .markdown ol,
+        .markdown blockquote,
+        .markdown .code-container,
+        .markdown .table-container {
+            margin: 8px 0;
+        }
+
+        .markdown h1,
+        .markdown h2,
+        .markdown h3,
+        .markdown h4,
+        .markdown h5,
+        .markdown h6 {
+            margin: 12px 0 6px;
+            line-height: 1.3;
+        }
+
+        .markdown ul,
+        .markdown ol {
+            padding-left: 22px;
+        }
+
+        .markdown li > p {
+            margin: 0;
+        }
+
+        .markdown blockquote {
+            padding-left: 12px;
+            border-left: 3px solid var(--primary);
+            opacity: 0.85;
+        }
+
+        .markdown hr {
+            border: none;
+            border-top: 1px solid rgba(255,255,255,0.2);
+            margin: 12px 0;
+        }
+
+        .markdown a {
+            color: inherit;
+            text-decoration: underline;
+            cursor: pointer;
+        }
+
+        .table-container {
+            overflow-x: auto;
+        }
+
+        .markdown table {
+            border-collapse: collapse;
+        }
+
+        .markdown th,
+        .markdown td {
+            padding: 6px 10px;
+            border: 1px solid rgba(255,255,255,0.2);
+            text-align: left;
+        }
+
+        .markdown th {
+            background: rgba(0,0,0,0.2);
+        }
+
+        .markdown .align-center {
+            text-align: center;
+        }
+
+        .markdown .align-right {
+            text-align: right;
+        }
+
         .copy-code-btn {
             position: absolute;
             top: 5px;
@@ -558,6 +3902,7 @@ html = """
     <div class="container">
         <div class="sidebar" id="sidebar">
             <h2>Chat History</h2>
+            <input type="text" id="history-search" class="history-search" placeholder="Search chats...">
             <div id="history-list" class="history-list">
                 <div class="new-chat-item" onclick="startNewChat()">Start New Chat</div>
             </div>
@@ -576,13 +3921,9 @@ html = """
                             <span class="arrow">▼</span>
                         </button>
                         <div class="model-list" id="text-model-list">
-                            <div class="model-option" onclick="selectModel('text', 'gpt-4', 'GPT-4')">GPT-4</div>
-                            <div class="model-option" onclick="selectModel('text', 'gpt-4o-mini', 'GPT-4o-Mini')">GPT-4o-Mini</div>
-                            <div class="model-option" onclick="selectModel('text', 'claude-3.5-sonnet', 'Claude 3.5 Sonnet')">Claude 3.5 Sonnet</div>
-                            <div class="model-option" onclick="selectModel('text', 'claude-3.5-haiku', 'Claude 3.5 Haiku')">Claude 3.5 Haiku</div>
-                            <div class="model-option" onclick="selectModel('text', 'blackboxai', 'BlackBoxAI')">BlackBoxAI</div>
-                            <div class="model-option" onclick="selectModel('text', 'mixtral-7b', 'Mixtral-7B')">Mixtral-7B</div>
-                            <div class="model-option" onclick="selectModel('text', 'mistral-nemo', 'Mistral Nemo')">Mistral Nemo</div>
+                            <div class="compare-options" id="compare-options">
+                                Compare
+                            </div>
                         </div>
                     </div>
 
@@ -591,248 +3932,1110 @@ html = """
                             <span id="image-model-label">DALL-E 3</span>
                             <span class="arrow">▼</span>
                         </button>
-                        <div class="model-list" id="image-model-list">
-                            <div class="model-option" onclick="selectModel('image', 'dall-e-3', 'DALL-E 3')">DALL-E 3</div>
-                            <div class="model-option" onclick="selectModel('image', 'flux', 'Flux')">Flux</div>
-                        </div>
+                        <div class="model-list" id="image-model-list"></div>
                     </div>
                 </div>
             </div>
 
-            <div class="messages" id="messages"></div>
+            <div class="messages" id="messages">
+                <div id="messages-top-spacer"></div>
+                <div id="messages-window"></div>
+                <div id="messages-bottom-spacer"></div>
+            </div>
 
             <div class="input-container">
                 <input type="text" id="input" placeholder="Type your message..." style="flex:1">
                 <button onclick="generateText()" id="text-btn">
                     <span>Generate Text</span>
                 </button>
+                <button onclick="compareModels()" id="compare-btn" title="Send the prompt to every model ticked under Compare">
+                    <span>Compare</span>
+                </button>
+                <label class="cache-toggle" id="cache-toggle" title="Skip cached answers for this request">
+                    <input type="checkbox" id="bypass-cache"> Fresh
+                </label>
                 <button onclick="generateImage()" id="image-btn">
                     <span>Generate Image</span>
                 </button>
+                <button onclick="stopGenerations()" id="stop-btn" title="Stop every running generation">
+                    <span>Stop</span>
+                </button>
             </div>
         </div>
     </div>
 
-    <div id="notification" class="notification"></div>
+    <div id="notification" class="notification"></div>
+
+    <div id="image-viewer" class="image-viewer" onclick="if (event.target === this) closeImageViewer()">
+        <img id="image-viewer-img" title="Click to open in browser">
+    </div>
+
+    <script id="markdown-worker" type="text/js-worker">
+        const KEYWORDS = {
+            js: 'async await break case catch class const continue default delete do else export extends finally for from function if import in instanceof let new of return static super switch this throw try typeof var void while yield null undefined true false',
+            python: 'and as assert async await break class continue def del elif else except False finally for from global if import in is lambda None nonlocal not or pass raise return True try while with yield self',
+            java: 'abstract boolean break byte case catch char class const continue default do double else enum extends final finally float for if implements import instanceof int interface long new null package private protected public return short static super switch this throw throws try var void while true false',
+            c: 'auto bool break case char class const continue default delete do double else enum extern false float for goto if inline int long namespace new nullptr private protected public register return short signed sizeof static struct switch template this true typedef typename union unsigned using virtual void volatile while NULL',
+            go: 'break case chan const continue default defer else fallthrough for func go goto if import interface map package range return select struct switch type var nil true false',
+            rust: 'as async await break const continue crate else enum extern false fn for if impl in let loop match mod move mut pub ref return self Self static struct super trait true type unsafe use where while',
+            bash: 'if then else elif fi for while until do done case esac function in return export local echo exit',
+            sql: 'select from where insert into values update set delete create table drop alter add index join left right inner outer on group by order having limit offset as and or not null is in like distinct union all primary key',
+            css: '',
+            json: 'true false null',
+        };
+        const LANGUAGE_ALIASES = {
+            javascript: 'js', jsx: 'js', ts: 'js', typescript: 'js', tsx: 'js', node: 'js',
+            py: 'python', python3: 'python',
+            cpp: 'c', 'c++': 'c', h: 'c', hpp: 'c', cs: 'java', csharp: 'java', kotlin: 'java', kt: 'java',
+            golang: 'go', rs: 'rust', sh: 'bash', shell: 'bash', zsh: 'bash', console: 'bash',
+            postgres: 'sql', postgresql: 'sql', mysql: 'sql', sqlite: 'sql', scss: 'css',
+        };
+        const STRING_PATTERN = /"(?:[^"\\\\\\n]|\\\\.)*"|'(?:[^'\\\\\\n]|\\\\.)*'|`(?:[^`\\\\]|\\\\.)*`/.source;
+        const NUMBER_PATTERN = /\\b(?:0[xX][0-9a-fA-F]+|\\d+(?:\\.\\d+)?(?:[eE][+-]?\\d+)?)\\b/.source;
+        const WORD_PATTERN = /[A-Za-z_$][\\w$]*/.source;
+        const tokenPatterns = {};
+        const keywordSets = {};
+        const streams = new Map();
+
+        function escapeHtml(text) {
+            return text.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;')
+                .replace(/"/g, '&quot;').replace(/'/g, '&#39;');
+        }
+
+        function commentPattern(lang) {
+            if (lang === 'python' || lang === 'bash') return /#.*/.source;
+            if (lang === 'sql') return /--.*/.source;
+            if (lang === 'css') return /\\/\\*[\\s\\S]*?\\*\\//.source;
+            if (lang === 'json') return /(?!)/.source;
+            return /\\/\\/.*|\\/\\*[\\s\\S]*?\\*\\//.source;
+        }
+
+        function tokenPattern(lang) {
+            if (!tokenPatterns[lang]) {
+                const strings = lang === 'python' ? /"{3}[\\s\\S]*?"{3}|'{3}[\\s\\S]*?'{3}/.source + '|' + STRING_PATTERN : STRING_PATTERN;
+                const groups = [commentPattern(lang), strings, NUMBER_PATTERN, WORD_PATTERN];
+                tokenPatterns[lang] = new RegExp(groups.map(group => `(${group})`).join('|'), 'g');
+            }
+            return tokenPatterns[lang];
+        }
+
+        function highlight(code, language) {
+            const lang = LANGUAGE_ALIASES[language] || language;
+            if (KEYWORDS[lang] === undefined) return escapeHtml(code);
+            const keywords = keywordSets[lang] || (keywordSets[lang] = new Set(KEYWORDS[lang].split(' ')));
+            let html = '';
+            let last = 0;
+            for (const match of code.matchAll(tokenPattern(lang))) {
+                const [text, comment, string, number] = match;
+                const word = lang === 'sql' ? text.toLowerCase() : text;
+                const kind = comment ? 'com' : string ? 'str' : number ? 'num' : keywords.has(word) ? 'kw' : null;
+                html += escapeHtml(code.slice(last, match.index));
+                html += kind ? `<span class="tok-${kind}">${escapeHtml(text)}</span>` : escapeHtml(text);
+                last = match.index + text.length;
+            }
+            return html + escapeHtml(code.slice(last));
+        }
+
+        function codeBlock(code, lang) {
+            const label = lang ? `<span class="code-lang">${escapeHtml(lang)}</span>` : '';
+            return `<div class="code-container">${label}<pre><code>${highlight(code, lang)}</code></pre>` +
+                '<button class="copy-code-btn">Copy</button></div>';
+        }
+
+        function link(label, url) {
+            if (!/^(https?:|mailto:)/i.test(url)) return escapeHtml(label);
+            return `<a href="${escapeHtml(url)}">${escapeHtml(label || url)}</a>`;
+        }
+
+        function inline(text) {
+            const stash = [];
+            const keep = (html) => `\\u0000${stash.push(html) - 1}\\u0000`;
+            let html = escapeHtml(text.replace(/\\u0000/g, '')
+                .replace(/(`+)([\\s\\S]*?[^`])\\1(?!`)/g, (match, ticks, code) => keep(`<code>${escapeHtml(code.trim())}</code>`))
+                .replace(/!?\\[([^\\]]*)\\]\\(([^()\\s]+)\\)/g, (match, label, url) => keep(link(label, url)))
+                .replace(/(^|[\\s(])(https?:\\/\\/[^\\s<>"]*[^\\s<>".,:;!?)\\]'])/g, (match, before, url) => before + keep(link(url, url))));
+            html = html.replace(/\\*\\*(?=\\S)([\\s\\S]*?\\S)\\*\\*/g, '<strong>$1</strong>');
+            html = html.replace(/(^|[^\\w])__(?=\\S)([\\s\\S]*?\\S)__(?!\\w)/g, '$1<strong>$2</strong>');
+            html = html.replace(/~~(?=\\S)([\\s\\S]*?\\S)~~/g, '<del>$1</del>');
+            html = html.replace(/\\*(?=[^\\s*])([^*]*?[^\\s*])\\*/g, '<em>$1</em>');
+            html = html.replace(/(^|[^\\w])_(?=[^\\s_])([^_]*?[^\\s_])_(?!\\w)/g, '$1<em>$2</em>');
+            return html.replace(/\\u0000(\\d+)\\u0000/g, (match, index) => stash[index]);
+        }
+
+        const FENCE_RE = /^ {0,3}(`{3,}|~{3,})\\s*([\\w+#.-]*)/;
+        const HEADING_RE = /^ {0,3}(#{1,6})\\s+(.*?)(?:\\s+#+)?\\s*$/;
+        const RULE_RE = /^ {0,3}([-*_])(?:\\s*\\1){2,}\\s*$/;
+        const QUOTE_RE = /^ {0,3}> ?/;
+        const LIST_RE = /^(\\s*)([-*+]|\\d{1,9}[.)])\\s+(.*)$/;
+        const TABLE_SEPARATOR_RE = /^\\s*\\|?\\s*:?-+:?\\s*(?:\\|\\s*:?-+:?\\s*)*\\|?\\s*$/;
+
+        function isTableStart(lines, i) {
+            return lines[i].includes('|') && i + 1 < lines.length && lines[i + 1].includes('-') &&
+                lines[i + 1].includes('|') && TABLE_SEPARATOR_RE.test(lines[i + 1]);
+        }
+
+        function startsBlock(lines, i) {
+            const line = lines[i];
+            return FENCE_RE.test(line) || HEADING_RE.test(line) || RULE_RE.test(line) || QUOTE_RE.test(line) ||
+                LIST_RE.test(line) || isTableStart(lines, i);
+        }
+
+        function splitRow(line) {
+            const cells = [];
+            let cell = '';
+            const body = line.trim().replace(/^\\|/, '').replace(/\\|$/, '');
+            for (let i = 0; i < body.length; i++) {
+                if (body[i] === '\\\\' && body[i + 1] === '|') {
+                    cell += '|';
+                    i++;
+                } else if (body[i] === '|') {
+                    cells.push(cell.trim());
+                    cell = '';
+                } else {
+                    cell += body[i];
+                }
+            }
+            cells.push(cell.trim());
+            return cells;
+        }
+
+        function renderTable(lines, start) {
+            const header = splitRow(lines[start]);
+            const aligns = splitRow(lines[start + 1]).map(cell => {
+                const left = cell.startsWith(':');
+                const right = cell.endsWith(':');
+                return left && right ? ' class="align-center"' : right ? ' class="align-right"' : '';
+            });
+            const row = (cells, tag) => '<tr>' + header.map((_, index) =>
+                `<${tag}${aligns[index] || ''}>${inline(cells[index] || '')}</${tag}>`).join('') + '</tr>';
+            let i = start + 2;
+            let body = '';
+            while (i < lines.length && lines[i].trim() && lines[i].includes('|')) {
+                body += row(splitRow(lines[i]), 'td');
+                i++;
+            }
+            return [`<div class="table-container"><table><thead>${row(header, 'th')}</thead><tbody>${body}</tbody></table></div>`, i];
+        }
+
+        function leadingSpaces(line) {
+            return line.length - line.trimStart().length;
+        }
+
+        function renderList(lines, start) {
+            const first = lines[start].match(LIST_RE);
+            const indent = first[1].length;
+            const ordered = /\\d/.test(first[2]);
+            const items = [];
+            let contentIndent = 0;
+            let i = start;
+            while (i < lines.length) {
+                const line = lines[i];
+                const match = line.match(LIST_RE);
+                if (match && match[1].length === indent && /\\d/.test(match[2]) === ordered) {
+                    items.push([match[3]]);
+                    contentIndent = indent + match[2].length + 1;
+                    i++;
+                } else if (!line.trim()) {
+                    let next = i + 1;
+                    while (next < lines.length && !lines[next].trim()) next++;
+                    const nextMatch = next < lines.length && lines[next].match(LIST_RE);
+                    const sameList = nextMatch && nextMatch[1].length === indent && /\\d/.test(nextMatch[2]) === ordered;
+                    if (next >= lines.length || (!sameList && leadingSpaces(lines[next]) <= indent)) break;
+                    items[items.length - 1].push('');
+                    i = next;
+                } else if (leadingSpaces(line) > indent) {
+                    items[items.length - 1].push(line.slice(Math.min(leadingSpaces(line), contentIndent)));
+                    i++;
+                } else if (!startsBlock(lines, i)) {
+                    items[items.length - 1].push(line.trim());
+                    i++;
+                } else {
+                    break;
+                }
+            }
+            const tag = ordered ? 'ol' : 'ul';
+            const number = parseInt(first[2], 10);
+            const startAttribute = ordered && number !== 1 ? ` start="${number}"` : '';
+            const html = items.map(item => {
+                if (item.length === 1) return `<li>${inline(item[0])}</li>`;
+                const body = renderBlocks(item.join('\\n'));
+                const single = body.startsWith('<p>') && body.endsWith('</p>') && body.indexOf('<p>', 3) === -1;
+                return `<li>${single ? body.slice(3, -4) : body}</li>`;
+            }).join('');
+            return [`<${tag}${startAttribute}>${html}</${tag}>`, i];
+        }
+
+        function renderBlocks(text) {
+            const lines = text.replace(/\\r\\n?/g, '\\n').split('\\n');
+            let html = '';
+            let i = 0;
+            while (i < lines.length) {
+                const line = lines[i];
+                let match;
+                if ((match = line.match(FENCE_RE))) {
+                    const fence = match[1];
+                    const body = [];
+                    i++;
+                    while (i < lines.length && !lines[i].trim().startsWith(fence)) {
+                        body.push(lines[i]);
+                        i++;
+                    }
+                    i++;
+                    html += codeBlock(body.join('\\n'), match[2].toLowerCase());
+                } else if (!line.trim()) {
+                    i++;
+                } else if ((match = line.match(HEADING_RE))) {
+                    const level = match[1].length;
+                    html += `<h${level}>${inline(match[2])}</h${level}>`;
+                    i++;
+                } else if (RULE_RE.test(line)) {
+                    html += '<hr>';
+                    i++;
+                } else if (QUOTE_RE.test(line)) {
+                    const quoted = [];
+                    while (i < lines.length && QUOTE_RE.test(lines[i])) {
+                        quoted.push(lines[i].replace(QUOTE_RE, ''));
+                        i++;
+                    }
+                    html += `<blockquote>${renderBlocks(quoted.join('\\n'))}</blockquote>`;
+                } else if (isTableStart(lines, i)) {
+                    const [table, next] = renderTable(lines, i);
+                    html += table;
+                    i = next;
+                } else if (LIST_RE.test(line)) {
+                    const [list, next] = renderList(lines, i);
+                    html += list;
+                    i = next;
+                } else {
+                    const paragraph = [];
+                    do {
+                        paragraph.push(lines[i].trim());
+                        i++;
+                    } while (i < lines.length && lines[i].trim() && !startsBlock(lines, i));
+                    html += `<p>${paragraph.map(inline).join('<br>')}</p>`;
+                }
+            }
+            return html;
+        }
+
+        function stableBoundary(text) {
+            let boundary = 0;
+            let pending = 0;
+            let fence = null;
+            let inList = false;
+            let offset = 0;
+            for (const line of text.split('\\n')) {
+                const end = offset + line.length + 1;
+                if (end > text.length) break;
+                if (fence) {
+                    if (line.trim().startsWith(fence)) fence = null;
+                } else if (!line.trim()) {
+                    pending = end;
+                } else {
+                    const listLine = LIST_RE.test(line) || (inList && /^\\s/.test(line));
+                    if (pending && !(inList && listLine)) boundary = pending;
+                    inList = listLine || (inList && !pending);
+                    pending = 0;
+                    const match = line.match(FENCE_RE);
+                    if (match) fence = match[1];
+                }
+                offset = end;
+            }
+            return boundary;
+        }
+
+        function renderStream(key, text) {
+            let state = streams.get(key);
+            if (!state || !text.startsWith(state.stable)) {
+                state = { stable: '', html: '' };
+                streams.set(key, state);
+            }
+            const boundary = stableBoundary(text);
+            if (boundary > state.stable.length) {
+                state.html += renderBlocks(text.slice(state.stable.length, boundary));
+                state.stable = text.slice(0, boundary);
+            }
+            return state.html + renderBlocks(text.slice(state.stable.length));
+        }
+
+        function forgetStream(key) {
+            streams.delete(key);
+        }
+
+        function renderRequest(request) {
+            try {
+                return request.key && !request.final ? renderStream(request.key, request.text) : renderBlocks(request.text);
+            } catch (e) {
+                return `<p>${escapeHtml(request.text).replace(/\\n/g, '<br>')}</p>`;
+            } finally {
+                if (request.final && request.key) forgetStream(request.key);
+            }
+        }
+
+        if (typeof WorkerGlobalScope !== 'undefined') {
+            self.onmessage = (event) => {
+                if (event.data.forget) {
+                    forgetStream(event.data.forget);
+                    return;
+                }
+                self.postMessage({ id: event.data.id, html: renderRequest(event.data) });
+            };
+        }
+    </script>
+
+    <script>
+        let activeModelMenu = null;
+        let lastUserPrompt = null;
+        const HISTORY_PAGE_SIZE = 50;
+        const MESSAGE_PAGE_SIZE = 50;
+        let historyOffset = 0;
+        let historyTotal = 0;
+        let historyLoading = false;
+        let currentChatId = null;
+        let oldestMessageIndex = 0;
+        let newestMessageIndex = 0;
+        let messageTotal = 0;
+        let messagesLoading = false;
+        let searchActive = false;
+        let searchTimer = null;
+        let requestCounter = 0;
+        const runningGenerations = {};
+
+        async function toggleSidebar() {
+            const sidebar = document.getElementById('sidebar');
+            const menuButton = document.getElementById('menu-button');
+            sidebar.classList.toggle('active');
+            menuButton.classList.toggle('active');
+
+            if (sidebar.classList.contains('active')) {
+                await updateHistory();
+            }
+        }
+
+        function toggleModelMenu(type) {
+            const menu = document.getElementById(`${type}-model-list`);
+            if (activeModelMenu && activeModelMenu !== menu) {
+                activeModelMenu.classList.remove('active');
+            }
+            menu.classList.toggle('active');
+            activeModelMenu = menu.classList.contains('active') ? menu : null;
+        }
+
+        const selectedModels = {text: 'gpt-4', image: 'dall-e-3'};
+
+        function selectModel(type, value, label) {
+            selectedModels[type] = value;
+            document.getElementById(`${type}-model-label`).textContent = label;
+            document.getElementById(`${type}-model-list`).classList.remove('active');
+            activeModelMenu = null;
+        }
+
+        function closeAllModelMenus() {
+            document.querySelectorAll('.model-list').forEach(menu => {
+                menu.classList.remove('active');
+            });
+            activeModelMenu = null;
+        }
+
+        document.addEventListener('click', (e) => {
+            if (!e.target.closest('.model-selector')) {
+                closeAllModelMenus();
+            }
+        });
+
+        function selectedTextModel() {
+            return selectedModels.text;
+        }
+
+        function renderModelOptions(type, models) {
+            const list = document.getElementById(`${type}-model-list`);
+            list.querySelectorAll('.model-option').forEach(option => option.remove());
+            const anchor = list.querySelector('.compare-options');
+            models.forEach(model => {
+                const option = document.createElement('div');
+                option.className = 'model-option';
+                option.textContent = model.label;
+                option.onclick = () => selectModel(type, model.id, model.label);
+                list.insertBefore(option, anchor);
+            });
+            const selected = models.find(model => model.id === selectedModels[type]) || models[0];
+            if (selected) {
+                selectedModels[type] = selected.id;
+                document.getElementById(`${type}-model-label`).textContent = selected.label;
+            }
+        }
+
+        function renderCompareOptions(models, defaults) {
+            const container = document.getElementById('compare-options');
+            const checked = new Set(Array.from(container.querySelectorAll('.compare-model:checked')).map(input => input.value));
+            container.querySelectorAll('label').forEach(label => label.remove());
+            models.filter(model => model.id !== 'auto').forEach(model => {
+                const label = document.createElement('label');
+                const input = document.createElement('input');
+                input.type = 'checkbox';
+                input.className = 'compare-model';
+                input.value = model.id;
+                input.checked = checked.size ? checked.has(model.id) : defaults.includes(model.id);
+                label.appendChild(input);
+                label.appendChild(document.createTextNode(' ' + model.label));
+                container.appendChild(label);
+            });
+        }
+
+        async function loadModels() {
+            const models = JSON.parse(await window.pywebview.api.get_models());
+            if (models.error) {
+                showTemporaryNotification(`Could not list models: ${models.error}`);
+                return;
+            }
+            renderModelOptions('text', models.text);
+            renderModelOptions('image', models.image);
+            renderCompareOptions(models.text, models.compare_defaults);
+        }
+
+        async function generateText() {
+            await submitGeneration('text', selectedTextModel());
+        }
+
+        async function generateImage() {
+            await submitGeneration('image', selectedModels.image);
+        }
+
+        async function takePrompt() {
+            const input = document.getElementById('input');
+            const prompt = input.value.trim();
+            if (!prompt) return null;
+
+            if (currentChatId !== null && newestMessageIndex < messageTotal) {
+                await loadChat(currentChatId);
+            }
+            lastUserPrompt = prompt;
+
+            addMessage(prompt, 'user');
+            input.value = '';
+            return prompt;
+        }
+
+        async function submitGeneration(kind, model) {
+            const prompt = await takePrompt();
+            if (!prompt) return;
+
+            const requestId = `request-${Date.now()}-${++requestCounter}`;
+            runningGenerations[requestId] = kind;
+            updateGenerationIndicators();
+            startPendingMessage(requestId, kind);
+
+            try {
+                const bypassCache = document.getElementById('bypass-cache').checked;
+                const response = JSON.parse(await window.pywebview.api.submit_generation(kind, model, prompt, requestId, bypassCache));
+                if (response.error) {
+                    onGenerationDone({request_id: requestId, kind: kind, state: 'error', result: `Error: ${response.error}`});
+                } else {
+                    currentChatId = response.chat_id;
+                }
+            } catch (e) {
+                onGenerationDone({request_id: requestId, kind: kind, state: 'error', result: `Error: ${e}`});
+            }
+        }
+
+        async function compareModels() {
+            const models = Array.from(document.querySelectorAll('.compare-model:checked')).map(input => input.value);
+            if (models.length < 2) {
+                showTemporaryNotification('Tick at least two models to compare');
+                return;
+            }
+            const prompt = await takePrompt();
+            if (!prompt) return;
+
+            const compareId = `compare-${Date.now()}-${++requestCounter}`;
+            const requestIds = models.map(model => `${compareId}:${model}`);
+            requestIds.forEach(requestId => { runningGenerations[requestId] = 'text'; });
+            updateGenerationIndicators();
+            startCompareMessage(compareId, models);
+
+            const fail = (error) => requestIds.forEach(requestId => {
+                onGenerationDone({request_id: requestId, kind: 'text', state: 'error', result: `Error: ${error}`});
+            });
+            try {
+                const bypassCache = document.getElementById('bypass-cache').checked;
+                const response = JSON.parse(await window.pywebview.api.compare(models, prompt, compareId, bypassCache));
+                if (response.error) {
+                    fail(response.error);
+                } else {
+                    currentChatId = response.chat_id;
+                }
+            } catch (e) {
+                fail(e);
+            }
+        }
+
+        function createCompareColumn(model, content) {
+            const column = document.createElement('div');
+            column.className = 'compare-column';
+            const header = document.createElement('div');
+            header.className = 'compare-header';
+            header.textContent = model;
+            column.appendChild(header);
+            column.appendChild(content);
+            return column;
+        }
+
+        function setCompareLatency(column, latencyMs) {
+            column.querySelector('.compare-header').textContent += ` · ${(latencyMs / 1000).toFixed(1)}s`;
+        }
+
+        function startCompareMessage(compareId, models) {
+            const group = document.createElement('div');
+            group.className = 'compare-group';
+            models.forEach(model => {
+                const message = createMessage('', 'ai');
+                message.classList.add('streaming');
+                pendingMessages[`${compareId}:${model}`] = message;
+                group.appendChild(createCompareColumn(model, message));
+            });
+            appendToMessages(group);
+            return group;
+        }
+
+        function createCompareGroup(answers) {
+            const group = document.createElement('div');
+            group.className = 'compare-group';
+            answers.forEach(answer => {
+                const message = createAIMessage(answer.ai || '');
+                if (answer.truncated) {
+                    message.classList.add('truncated');
+                }
+                const column = createCompareColumn(answer.model, message);
+                setCompareLatency(column, answer.latency_ms);
+                group.appendChild(column);
+            });
+            return group;
+        }
+
+        function onGenerationDone(job) {
+            delete runningGenerations[job.request_id];
+            updateGenerationIndicators();
+            const renderStart = performance.now();
+            const pending = pendingMessages[job.request_id];
+            forgetStream(job.request_id);
+            if (job.compare_id && pending && job.latency_ms !== undefined) {
+                setCompareLatency(pending.parentElement, job.latency_ms);
+            }
+            if (job.truncated) {
+                const message = createAIMessage(job.result, pending);
+                message.classList.add('truncated');
+                finishPendingMessage(job.request_id, message);
+            } else if (job.state === 'error' || job.state === 'cancelled' || job.state === 'timeout') {
+                finishPendingMessage(job.request_id, createMessage(job.result, 'error'));
+            } else if (job.kind === 'image') {
+                finishPendingMessage(job.request_id, createImage(job.result));
+            } else {
+                finishPendingMessage(job.request_id, createAIMessage(job.result, pending));
+            }
+            requestAnimationFrame(() => {
+                window.pywebview.api.report_render(job.request_id, performance.now() - renderStart);
+            });
+        }
+
+        async function stopGenerations() {
+            for (const requestId of Object.keys(runningGenerations)) {
+                await window.pywebview.api.cancel(requestId);
+            }
+        }
+
+        function updateGenerationIndicators() {
+            document.getElementById('stop-btn').classList.toggle('active', Object.keys(runningGenerations).length > 0);
+            ['text', 'image'].forEach(kind => {
+                const btn = document.getElementById(`${kind}-btn`);
+                const running = Object.values(runningGenerations).filter(k => k === kind).length;
+                let loader = btn.querySelector('.loader');
+                if (running > 0 && !loader) {
+                    btn.appendChild(createLoader());
+                    btn.style.opacity = '0.8';
+                } else if (running === 0 && loader) {
+                    loader.remove();
+                    btn.style.opacity = '1';
+                }
+            });
+        }
 
-    <script>
-        let isGenerating = false;
-        let activeModelMenu = null;
-        let lastUserPrompt = null;
+        const ESTIMATED_ROW_HEIGHT = 90;
+        const RENDER_BUFFER_PX = 800;
+        let messageRows = [];
+        let renderScheduled = false;
+        let pinToBottom = true;
+        let pendingScrollAdjust = 0;
+        let pendingScrollRow = null;
 
-        async function toggleSidebar() {
-            const sidebar = document.getElementById('sidebar');
-            const menuButton = document.getElementById('menu-button');
-            sidebar.classList.toggle('active');
-            menuButton.classList.toggle('active');
+        function scheduleRender() {
+            if (renderScheduled) return;
+            renderScheduled = true;
+            requestAnimationFrame(renderVisibleRows);
+        }
 
-            if (sidebar.classList.contains('active')) {
-                await updateHistory();
-            }
+        function rowHeight(row) {
+            return row.height || ESTIMATED_ROW_HEIGHT;
         }
 
-        function toggleModelMenu(type) {
-            const menu = document.getElementById(`${type}-model-list`);
-            if (activeModelMenu && activeModelMenu !== menu) {
-                activeModelMenu.classList.remove('active');
+        function createRowElement(row) {
+            const wrapper = document.createElement('div');
+            wrapper.className = row.live ? 'message-row' : 'message-row restored';
+            if (row.highlight) {
+                wrapper.classList.add('search-hit');
             }
-            menu.classList.toggle('active');
-            activeModelMenu = menu.classList.contains('active') ? menu : null;
+            if (!row.content) {
+                row.content = createStoredMessage(row.msg);
+            }
+            wrapper.appendChild(row.content);
+            return wrapper;
         }
 
-        function selectModel(type, value, label) {
-            document.getElementById(`${type}-model-label`).textContent = label;
-            document.getElementById(`${type}-model-list`).classList.remove('active');
-            activeModelMenu = null;
+        function unmountRow(row) {
+            if (!row.wrapper) return;
+            row.wrapper.remove();
+            row.wrapper.classList.add('restored');
+            if (!row.live) {
+                row.wrapper.querySelectorAll('img.loading').forEach(img => imageObserver.unobserve(img));
+                row.wrapper = null;
+                row.content = null;
+            }
         }
 
-        function closeAllModelMenus() {
-            document.querySelectorAll('.model-list').forEach(menu => {
-                menu.classList.remove('active');
-            });
-            activeModelMenu = null;
-        }
+        function renderVisibleRows() {
+            renderScheduled = false;
+            const messages = document.getElementById('messages');
+            const topSpacer = document.getElementById('messages-top-spacer');
+            const rowWindow = document.getElementById('messages-window');
+            const bottomSpacer = document.getElementById('messages-bottom-spacer');
 
-        document.addEventListener('click', (e) => {
-            if (!e.target.closest('.model-selector')) {
-                closeAllModelMenus();
+            if (pendingScrollAdjust) {
+                messages.scrollTop += pendingScrollAdjust;
+                pendingScrollAdjust = 0;
             }
-        });
+            const totalHeight = messageRows.reduce((sum, row) => sum + rowHeight(row), 0);
+            const scrollTop = pinToBottom ? Math.max(totalHeight - messages.clientHeight, 0) : messages.scrollTop;
+            const viewTop = scrollTop - RENDER_BUFFER_PX;
+            const viewBottom = scrollTop + messages.clientHeight + RENDER_BUFFER_PX;
 
-        async function generateText() {
-            if (isGenerating) return;
-            isGenerating = true;
-            
-            const input = document.getElementById('input');
-            const modelLabel = document.getElementById('text-model-label').textContent;
-            const modelMap = {
-                'GPT-4': 'gpt-4',
-                'GPT-4o-Mini': 'gpt-4o-mini',
-                'Claude 3.5 Sonnet': 'claude-3.5-sonnet',
-                'Claude 3.5 Haiku': 'claude-3.5-haiku',
-                'BlackBoxAI': 'blackboxai',
-                'Mixtral-7B': 'mixtral-7b',
-                'Mistral Nemo': 'mistral-nemo'
-            };
-            const model = modelMap[modelLabel] || 'gpt-4';
-            const prompt = input.value.trim();
-            if (!prompt) {
-                isGenerating = false;
-                return;
+            let start = messageRows.length;
+            let end = messageRows.length;
+            let offset = 0;
+            let topHeight = 0;
+            for (let i = 0; i < messageRows.length; i++) {
+                const height = rowHeight(messageRows[i]);
+                if (start === messageRows.length && offset + height >= viewTop) {
+                    start = i;
+                    topHeight = offset;
+                }
+                if (offset > viewBottom) {
+                    end = i;
+                    break;
+                }
+                offset += height;
             }
 
-            lastUserPrompt = prompt;
+            let bottomHeight = 0;
+            messageRows.forEach((row, i) => {
+                if (i < start || i >= end) {
+                    unmountRow(row);
+                }
+                if (i >= end) {
+                    bottomHeight += rowHeight(row);
+                }
+            });
 
-            addMessage(prompt, 'user');
-            input.value = '';
-            
-            const btn = document.getElementById('text-btn');
-            btn.style.opacity = '0.8';
-            btn.style.pointerEvents = 'none';
-            const loader = createLoader();
-            btn.appendChild(loader);
-            
-            try {
-                const response = await window.pywebview.api.generate_text(model, prompt);
-                if (response.startsWith("Error:")) {
-                    addMessage(response, 'error');
-                } else {
-                    addAIMessage(response);
+            const fragment = document.createDocumentFragment();
+            for (let i = start; i < end; i++) {
+                const row = messageRows[i];
+                if (!row.wrapper) {
+                    row.wrapper = createRowElement(row);
                 }
-            } catch (e) {
-                addMessage(`Error: ${e}`, 'error');
+                fragment.appendChild(row.wrapper);
             }
-            
-            loader.remove();
-            btn.style.opacity = '1';
-            btn.style.pointerEvents = 'all';
-            isGenerating = false;
-        }
+            rowWindow.replaceChildren(fragment);
+            topSpacer.style.height = `${topHeight}px`;
+            bottomSpacer.style.height = `${bottomHeight}px`;
 
-        async function generateImage() {
-            if (isGenerating) return;
-            isGenerating = true;
-            
-            const input = document.getElementById('input');
-            const modelLabel = document.getElementById('image-model-label').textContent;
-            const modelMap = {
-                'DALL-E 3': 'dall-e-3',
-                'Flux': 'flux'
-            };
-            const model = modelMap[modelLabel] || 'dall-e-3';
-            const prompt = input.value.trim();
-            if (!prompt) {
-                isGenerating = false;
-                return;
+            let anchorDelta = 0;
+            let rowTop = topHeight;
+            for (let i = start; i < end; i++) {
+                const row = messageRows[i];
+                const height = row.wrapper.offsetHeight;
+                if (height !== row.height) {
+                    if (rowTop + rowHeight(row) <= messages.scrollTop) {
+                        anchorDelta += height - rowHeight(row);
+                    }
+                    row.height = height;
+                }
+                rowTop += height;
             }
+            if (pinToBottom) {
+                messages.scrollTop = messages.scrollHeight;
+            } else if (pendingScrollRow !== null) {
+                const target = messageRows.slice(0, pendingScrollRow).reduce((sum, row) => sum + rowHeight(row), 0);
+                messages.scrollTop = Math.max(target - messages.clientHeight / 3, 0);
+                pendingScrollRow = null;
+                scheduleRender();
+            } else if (anchorDelta) {
+                messages.scrollTop += anchorDelta;
+            }
+        }
 
-            lastUserPrompt = prompt;
+        function scrollToRow(index) {
+            if (index < 0 || index >= messageRows.length) return;
+            messageRows.forEach(row => { row.highlight = false; });
+            messageRows[index].highlight = true;
+            pinToBottom = false;
+            pendingScrollRow = index;
+            scheduleRender();
+        }
 
-            addMessage(prompt, 'user');
-            input.value = '';
-            
-            const btn = document.getElementById('image-btn');
-            btn.style.opacity = '0.8';
-            btn.style.pointerEvents = 'none';
-            const loader = createLoader();
-            btn.appendChild(loader);
-            
-            try {
-                const url = await window.pywebview.api.generate_image(model, prompt);
-                if (url.startsWith("Error:")) {
-                    addMessage(url, 'error');
+        function resetMessageRows() {
+            messageRows.forEach(unmountRow);
+            messageRows = [];
+            pinToBottom = true;
+            pendingScrollAdjust = 0;
+            pendingScrollRow = null;
+            scheduleRender();
+        }
+
+        function toStoredRows(storedMessages) {
+            const rows = [];
+            storedMessages.forEach(msg => {
+                const last = rows[rows.length - 1];
+                if (msg.compare && last && last.msg.compare === msg.compare) {
+                    last.msg.answers.push(msg);
+                } else if (msg.compare) {
+                    rows.push({ msg: { compare: msg.compare, answers: [msg] }, live: false });
                 } else {
-                    addImage(url);
+                    rows.push({ msg: msg, live: false });
                 }
-            } catch (e) {
-                addMessage(`Error: ${e}`, 'error');
+            });
+            return rows;
+        }
+
+        function joinStoredRows(before, after) {
+            const last = before[before.length - 1];
+            const first = after[0];
+            if (last && first && !last.live && !first.live && last.msg.compare && last.msg.compare === first.msg.compare) {
+                unmountRow(last);
+                unmountRow(first);
+                last.msg.answers = last.msg.answers.concat(first.msg.answers);
+                last.height = 0;
+                return before.concat(after.slice(1));
             }
-            
-            loader.remove();
-            btn.style.opacity = '1';
-            btn.style.pointerEvents = 'all';
-            isGenerating = false;
+            return before.concat(after);
         }
 
-        function addMessage(text, type) {
-            const messages = document.getElementById('messages');
+        function setStoredMessages(storedMessages) {
+            resetMessageRows();
+            messageRows = toStoredRows(storedMessages);
+            scheduleRender();
+        }
+
+        function prependStoredMessages(storedMessages) {
+            const count = messageRows.length;
+            messageRows = joinStoredRows(toStoredRows(storedMessages), messageRows);
+            pendingScrollAdjust += (messageRows.length - count) * ESTIMATED_ROW_HEIGHT;
+            scheduleRender();
+        }
+
+        function appendStoredMessages(storedMessages) {
+            messageRows = joinStoredRows(messageRows, toStoredRows(storedMessages));
+            scheduleRender();
+        }
+
+        function appendToMessages(element) {
+            messageRows.push({ content: element, live: true });
+            pinToBottom = true;
+            scheduleRender();
+        }
+
+        function replaceRowContent(oldElement, newElement) {
+            const row = messageRows.find(r => r.content === oldElement);
+            if (!row) return false;
+            row.content = newElement;
+            if (row.wrapper) {
+                row.wrapper.replaceChildren(newElement);
+            }
+            scheduleRender();
+            return true;
+        }
+
+        function createMessage(text, type) {
             const message = document.createElement('div');
             message.className = `message ${type}`;
             message.textContent = text;
+            return message;
+        }
 
-            messages.appendChild(message);
-            messages.scrollTop = messages.scrollHeight;
+        function addMessage(text, type) {
+            appendToMessages(createMessage(text, type));
         }
 
         function addAIMessage(text) {
-            const messages = document.getElementById('messages');
-            const message = document.createElement('div');
-            message.className = 'message ai';
-
-            const codeRegex = /`([^`]+)`/g;
-            let match;
-            let lastIndex = 0;
-            const fragments = [];
-
-            while ((match = codeRegex.exec(text)) !== null) {
-                if (match.index > lastIndex) {
-                    const textBefore = text.substring(lastIndex, match.index);
-                    if (textBefore.trim() !== '') {
-                        fragments.push(document.createTextNode(textBefore));
-                    }
-                }
+            appendToMessages(createAIMessage(text));
+        }
 
-                const codeContainer = document.createElement('div');
-                codeContainer.className = 'code-container';
+        function addImage(url) {
+            appendToMessages(createImage(url));
+        }
 
-                const pre = document.createElement('pre');
-                const code = document.createElement('code');
-                code.textContent = match[1];
-                pre.appendChild(code);
-                codeContainer.appendChild(pre);
+        const pendingMessages = {};
 
-                const copyCodeBtn = document.createElement('button');
-                copyCodeBtn.className = 'copy-code-btn';
-                copyCodeBtn.textContent = 'Copy';
-                copyCodeBtn.addEventListener('click', () => copyText(match[1]));
-                codeContainer.appendChild(copyCodeBtn);
+        function startPendingMessage(requestId, kind) {
+            const message = createMessage('', 'ai');
+            if (kind === 'text') {
+                message.classList.add('streaming', 'markdown');
+            } else {
+                message.appendChild(createLoader());
+            }
+            pendingMessages[requestId] = message;
+            appendToMessages(message);
+            return message;
+        }
 
-                fragments.push(codeContainer);
+        const streamTexts = {};
+        const streamRenders = {};
 
-                lastIndex = codeRegex.lastIndex;
+        function onTextChunk(chunk) {
+            const message = pendingMessages[chunk.stream_id];
+            if (!message) return;
+            streamTexts[chunk.stream_id] = (chunk.reset ? '' : streamTexts[chunk.stream_id] || '') + chunk.text;
+            if (!message.classList.contains('rendered')) {
+                if (chunk.reset) {
+                    message.textContent = '';
+                }
+                message.textContent += chunk.text;
             }
+            requestStreamRender(chunk.stream_id);
+            scheduleRender();
+        }
 
-            if (lastIndex < text.length) {
-                const remainingText = text.substring(lastIndex);
-                if (remainingText.trim() !== '') {
-                    fragments.push(document.createTextNode(remainingText));
+        function requestStreamRender(streamId) {
+            const state = streamRenders[streamId] || (streamRenders[streamId] = { busy: false, dirty: false });
+            if (state.busy) {
+                state.dirty = true;
+                return;
+            }
+            state.busy = true;
+            renderMarkdown(streamTexts[streamId], streamId, false).then(html => {
+                state.busy = false;
+                const message = pendingMessages[streamId];
+                if (!message) return;
+                message.innerHTML = html;
+                message.classList.add('rendered');
+                scheduleRender();
+                if (state.dirty) {
+                    state.dirty = false;
+                    requestStreamRender(streamId);
                 }
+            });
+        }
+
+        function forgetStream(streamId) {
+            delete streamTexts[streamId];
+            delete streamRenders[streamId];
+            forgetMarkdownStream(streamId);
+        }
+
+        function finishPendingMessage(requestId, finalMessage) {
+            const message = pendingMessages[requestId];
+            delete pendingMessages[requestId];
+            if (!message) return;
+            if (message.parentElement && message.parentElement.classList.contains('compare-column')) {
+                message.replaceWith(finalMessage);
+                scheduleRender();
+            } else {
+                replaceRowContent(message, finalMessage);
+            }
+        }
+
+        const RENDER_CACHE_CHARS = 2000000;
+        const renderCache = new Map();
+        const renderingMessages = new Map();
+        const pendingRenders = new Map();
+        let renderCacheChars = 0;
+        let nextRenderId = 0;
+        let markdownWorker = null;
+        let markdownFallback = null;
+
+        function startMarkdownWorker() {
+            const source = document.getElementById('markdown-worker').textContent;
+            try {
+                markdownWorker = new Worker(URL.createObjectURL(new Blob([source], { type: 'text/javascript' })));
+            } catch (e) {
+                console.error('Markdown worker unavailable, rendering on the main thread:', e);
+                return;
+            }
+            markdownWorker.onmessage = (event) => {
+                const render = pendingRenders.get(event.data.id);
+                if (!render) return;
+                pendingRenders.delete(event.data.id);
+                render.resolve(event.data.html);
+            };
+            markdownWorker.onerror = (event) => {
+                console.error('Markdown worker failed, rendering on the main thread:', event.message);
+                markdownWorker.terminate();
+                markdownWorker = null;
+                pendingRenders.forEach(render => render.resolve(renderOnMainThread(render.request)));
+                pendingRenders.clear();
+            };
+        }
+
+        function renderOnMainThread(request) {
+            if (!markdownFallback) {
+                const source = document.getElementById('markdown-worker').textContent;
+                markdownFallback = new Function(`${source}\\nreturn { renderRequest, forgetStream };`)();
             }
+            return markdownFallback.renderRequest(request);
+        }
 
-            fragments.forEach(fragment => {
-                message.appendChild(fragment);
+        function renderMarkdown(text, key = null, final = true) {
+            const request = { id: ++nextRenderId, key, text, final };
+            if (!markdownWorker) {
+                return Promise.resolve(renderOnMainThread(request));
+            }
+            return new Promise(resolve => {
+                pendingRenders.set(request.id, { request, resolve });
+                markdownWorker.postMessage(request);
             });
+        }
 
-            messages.appendChild(message);
-            messages.scrollTop = messages.scrollHeight;
+        function forgetMarkdownStream(key) {
+            if (markdownWorker) {
+                markdownWorker.postMessage({ forget: key });
+            } else if (markdownFallback) {
+                markdownFallback.forgetStream(key);
+            }
         }
 
-        function addImage(url) {
-            const messages = document.getElementById('messages');
+        function cachedMarkdown(text) {
+            const html = renderCache.get(text);
+            if (html !== undefined) {
+                renderCache.delete(text);
+                renderCache.set(text, html);
+            }
+            return html;
+        }
+
+        function rememberMarkdown(text, html) {
+            if (renderCache.has(text)) return;
+            renderCache.set(text, html);
+            renderCacheChars += text.length + html.length;
+            for (const [key, value] of renderCache) {
+                if (renderCacheChars <= RENDER_CACHE_CHARS) break;
+                renderCache.delete(key);
+                renderCacheChars -= key.length + value.length;
+            }
+        }
+
+        function renderMessageMarkdown(text) {
+            let render = renderingMessages.get(text);
+            if (!render) {
+                render = renderMarkdown(text).then(html => {
+                    renderingMessages.delete(text);
+                    rememberMarkdown(text, html);
+                    return html;
+                });
+                renderingMessages.set(text, render);
+            }
+            return render;
+        }
+
+        function createAIMessage(text, placeholder = null) {
+            const message = document.createElement('div');
+            message.className = 'message ai markdown';
+
+            const html = cachedMarkdown(text);
+            if (html !== undefined) {
+                message.innerHTML = html;
+                return message;
+            }
+            if (placeholder && placeholder.classList.contains('rendered')) {
+                message.innerHTML = placeholder.innerHTML;
+            } else {
+                message.classList.add('plain');
+                message.textContent = text;
+            }
+            renderMessageMarkdown(text).then(rendered => {
+                message.innerHTML = rendered;
+                message.classList.remove('plain');
+                scheduleRender();
+            });
+            return message;
+        }
+
+        function createImage(url) {
             const container = document.createElement('div');
             container.className = 'message ai';
             
             const img = document.createElement('img');
-            img.src = url;
-            img.className = 'message-image';
-            img.title = 'Click to open in browser';
+            img.className = 'message-image loading';
+            img.title = 'Click to view full size';
+            img.dataset.url = url;
+            imageObserver.observe(img);
 
-            img.addEventListener('click', () => window.pywebview.api.open_url(url));
+            img.addEventListener('click', () => openImageViewer(url));
+            img.addEventListener('load', scheduleRender);
 
             container.appendChild(img);
 
-            messages.appendChild(container);
-            messages.scrollTop = messages.scrollHeight;
+            return container;
+        }
+
+        const imageObserver = new IntersectionObserver((entries) => {
+            entries.forEach(entry => {
+                if (!entry.isIntersecting) return;
+                imageObserver.unobserve(entry.target);
+                loadThumbnail(entry.target);
+            });
+        }, { root: document.getElementById('messages'), rootMargin: '200px' });
+
+        async function loadThumbnail(img) {
+            const url = img.dataset.url;
+            try {
+                const data = await window.pywebview.api.get_image(url, 'thumb');
+                img.src = data.startsWith('Error:') ? url : data;
+            } catch (e) {
+                img.src = url;
+            }
+            img.classList.remove('loading');
+        }
+
+        async function openImageViewer(url) {
+            const viewer = document.getElementById('image-viewer');
+            const full = document.getElementById('image-viewer-img');
+            full.removeAttribute('src');
+            full.onclick = () => window.pywebview.api.open_url(url);
+            viewer.classList.add('active');
+            try {
+                const data = await window.pywebview.api.get_image(url, 'full');
+                full.src = data.startsWith('Error:') ? url : data;
+            } catch (e) {
+                full.src = url;
+            }
+        }
+
+        function closeImageViewer() {
+            document.getElementById('image-viewer').classList.remove('active');
+        }
+
+        function createStoredMessage(msg) {
+            if (msg.answers) {
+                return createCompareGroup(msg.answers);
+            }
+            if (msg.user) {
+                return createMessage(msg.user, 'user');
+            }
+            if (msg.image) {
+                return createImage(msg.image);
+            }
+            const message = createAIMessage(msg.ai || '');
+            if (msg.truncated) {
+                message.classList.add('truncated');
+            }
+            return message;
         }
 
         function createLoader() {
@@ -851,45 +5054,229 @@ html = """
             newChatItem.onclick = () => startNewChat();
             historyList.appendChild(newChatItem);
 
+            historyOffset = 0;
+            historyTotal = 0;
+            await loadMoreHistory();
+        }
+
+        function renderSnippet(snippet) {
+            const container = document.createElement('div');
+            container.className = 'search-snippet';
+            snippet.split('\\x02').forEach((part, index) => {
+                const [marked, rest] = index === 0 ? [null, part] : part.split('\\x03');
+                if (marked !== null) {
+                    const mark = document.createElement('mark');
+                    mark.textContent = marked;
+                    container.appendChild(mark);
+                }
+                if (rest) {
+                    container.appendChild(document.createTextNode(rest));
+                }
+            });
+            return container;
+        }
+
+        async function searchHistory(query) {
+            if (!query) {
+                searchActive = false;
+                await updateHistory();
+                return;
+            }
+            searchActive = true;
+            const historyList = document.getElementById('history-list');
+
+            try {
+                const response = JSON.parse(await window.pywebview.api.search_history(query, 20));
+                if (document.getElementById('history-search').value.trim() !== query) return;
+                historyList.innerHTML = '';
+                if (response.error) {
+                    showTemporaryNotification('Search failed');
+                    return;
+                }
+                if (response.results.length === 0) {
+                    const empty = document.createElement('div');
+                    empty.className = 'history-item';
+                    empty.textContent = 'No matches';
+                    historyList.appendChild(empty);
+                    return;
+                }
+                const fragment = document.createDocumentFragment();
+                response.results.forEach(result => {
+                    const item = document.createElement('div');
+                    item.className = 'history-item';
+                    item.textContent = result.title || `Chat ${result.chat_id}`;
+                    item.title = item.textContent;
+                    item.appendChild(renderSnippet(result.snippet));
+                    item.onclick = () => loadChat(result.chat_id, result.index);
+                    fragment.appendChild(item);
+                });
+                historyList.appendChild(fragment);
+            } catch (e) {
+                console.error('Failed to search history:', e);
+                showTemporaryNotification('Search failed');
+            }
+        }
+
+        document.getElementById('history-search').addEventListener('input', (e) => {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(() => searchHistory(e.target.value.trim()), 200);
+        });
+
+        async function loadMoreHistory() {
+            if (historyLoading) return;
+            historyLoading = true;
+            const historyList = document.getElementById('history-list');
+
             try {
-                const history = JSON.parse(await window.pywebview.api.get_history());
-                history.forEach((chat, index) => {
+                const page = JSON.parse(await window.pywebview.api.list_chats(historyOffset, HISTORY_PAGE_SIZE));
+                historyTotal = page.total;
+                if (page.loading) {
+                    const loading = document.createElement('div');
+                    loading.className = 'history-item';
+                    loading.textContent = 'Loading history...';
+                    historyList.appendChild(loading);
+                }
+                const fragment = document.createDocumentFragment();
+                page.chats.forEach((chat, index) => {
                     const item = document.createElement('div');
                     item.className = 'history-item';
                     const date = new Date(chat.timestamp * 1000).toLocaleString();
-                    item.textContent = `Chat ${index + 1} - ${date}`;
-                    item.onclick = () => loadChat(chat);
-                    historyList.appendChild(item);
+                    const title = chat.title || `Chat ${historyTotal - historyOffset - index}`;
+                    item.textContent = `${title} - ${date}${chat.archived ? ' (archived)' : ''}`;
+                    item.title = title;
+                    item.onclick = () => loadChat(chat.id);
+                    fragment.appendChild(item);
                 });
+                historyList.appendChild(fragment);
+                historyOffset += page.chats.length;
             } catch (e) {
                 console.error('Failed to load history:', e);
                 showTemporaryNotification('Failed to load chat history');
             }
+            historyLoading = false;
         }
 
-        async function loadChat(chat) {
-            const messages = document.getElementById('messages');
-            messages.innerHTML = '';
-            chat.messages.forEach(msg => {
-                if (msg.user) {
-                    addMessage(msg.user, 'user');
+        document.getElementById('sidebar').addEventListener('scroll', (e) => {
+            const sidebar = e.target;
+            if (!searchActive && historyOffset < historyTotal && sidebar.scrollTop + sidebar.clientHeight >= sidebar.scrollHeight - 100) {
+                loadMoreHistory();
+            }
+        });
+
+        function onHistoryError(info) {
+            showTemporaryNotification('Chat history could not be saved: ' + info.error);
+        }
+
+        function onHistoryLoaded(info) {
+            if (info.error) {
+                showTemporaryNotification('Chat history could not be loaded: ' + info.error);
+            }
+            if (document.getElementById('sidebar').classList.contains('active') && !searchActive) {
+                updateHistory();
+            }
+        }
+
+        async function loadChat(chatId, around = null) {
+            resetMessageRows();
+
+            try {
+                const page = JSON.parse(await window.pywebview.api.open_chat(chatId, MESSAGE_PAGE_SIZE, around));
+                if (page.error) {
+                    showTemporaryNotification(page.error);
+                    return;
                 }
-                if (msg.ai) {
-                    addAIMessage(msg.ai);
+                currentChatId = chatId;
+                oldestMessageIndex = page.start;
+                newestMessageIndex = page.start + page.messages.length;
+                messageTotal = page.total;
+                setStoredMessages(page.messages);
+                if (around !== null) {
+                    scrollToRow(toStoredRows(page.messages.slice(0, around - page.start + 1)).length - 1);
                 }
-                if (msg.image) {
-                    addImage(msg.image);
+                if (newestMessageIndex >= messageTotal) {
+                    const comparisons = {};
+                    page.pending.forEach(job => {
+                        if (job.compare_id) {
+                            (comparisons[job.compare_id] = comparisons[job.compare_id] || []).push(job.model);
+                        } else {
+                            startPendingMessage(job.request_id, job.kind);
+                        }
+                    });
+                    Object.entries(comparisons).forEach(([compareId, models]) => startCompareMessage(compareId, models));
                 }
-            });
+            } catch (e) {
+                console.error('Failed to load chat:', e);
+                showTemporaryNotification('Failed to load chat');
+            }
+        }
+
+        async function loadOlderMessages() {
+            if (messagesLoading || currentChatId === null || oldestMessageIndex <= 0) return;
+            messagesLoading = true;
+
+            try {
+                const page = JSON.parse(await window.pywebview.api.get_messages(currentChatId, oldestMessageIndex, MESSAGE_PAGE_SIZE));
+                if (!page.error && page.id === currentChatId) {
+                    prependStoredMessages(page.messages);
+                    oldestMessageIndex = page.start;
+                }
+            } catch (e) {
+                console.error('Failed to load older messages:', e);
+            }
+            messagesLoading = false;
+        }
+
+        async function loadNewerMessages() {
+            if (messagesLoading || currentChatId === null || newestMessageIndex >= messageTotal) return;
+            messagesLoading = true;
 
-            await window.pywebview.api.load_chat(chat.messages);
+            try {
+                const page = JSON.parse(await window.pywebview.api.get_messages(currentChatId, newestMessageIndex + MESSAGE_PAGE_SIZE, MESSAGE_PAGE_SIZE));
+                if (!page.error && page.id === currentChatId) {
+                    appendStoredMessages(page.messages.slice(newestMessageIndex - page.start));
+                    newestMessageIndex = page.start + page.messages.length;
+                    messageTotal = page.total;
+                }
+            } catch (e) {
+                console.error('Failed to load newer messages:', e);
+            }
+            messagesLoading = false;
         }
 
+        document.getElementById('messages').addEventListener('click', (e) => {
+            const copyButton = e.target.closest('.copy-code-btn');
+            if (copyButton) {
+                copyText(copyButton.parentElement.querySelector('code').textContent);
+                return;
+            }
+            const link = e.target.closest('.message a[href]');
+            if (link) {
+                e.preventDefault();
+                window.pywebview.api.open_url(link.href);
+            }
+        });
+
+        document.getElementById('messages').addEventListener('scroll', (e) => {
+            const messages = e.target;
+            const distanceToBottom = messages.scrollHeight - messages.scrollTop - messages.clientHeight;
+            pinToBottom = distanceToBottom < 50 && newestMessageIndex >= messageTotal;
+            scheduleRender();
+            if (messages.scrollTop < RENDER_BUFFER_PX) {
+                loadOlderMessages();
+            }
+            if (distanceToBottom < RENDER_BUFFER_PX) {
+                loadNewerMessages();
+            }
+        });
+
         async function startNewChat() {
             await window.pywebview.api.save_chat();
+            currentChatId = null;
+            oldestMessageIndex = 0;
+            newestMessageIndex = 0;
+            messageTotal = 0;
 
-            const messages = document.getElementById('messages');
-            messages.innerHTML = '';
+            resetMessageRows();
             showTemporaryNotification('New chat started');
         }
 
@@ -918,6 +5305,22 @@ html = """
             }, 2000);
         }
 
+        startMarkdownWorker();
+
+        window.addEventListener('pywebviewready', async () => {
+            requestAnimationFrame(() => window.pywebview.api.report_startup('first_paint'));
+            loadModels();
+            const stats = JSON.parse(await window.pywebview.api.get_cache_stats());
+            document.getElementById('cache-toggle').style.display = stats.enabled ? 'flex' : 'none';
+        });
+
+        let lastWarmUp = 0;
+        document.getElementById('input').addEventListener('input', () => {
+            if (Date.now() - lastWarmUp < 10000 || !window.pywebview) return;
+            lastWarmUp = Date.now();
+            window.pywebview.api.warm_up(selectedTextModel());
+        });
+
         document.getElementById('input').addEventListener('keypress', (e) => {
             if (e.key === 'Enter' && !e.shiftKey) {
                 e.preventDefault();
@@ -930,12 +5333,97 @@ html = """
 """
 
 if __name__ == '__main__':
-    api = Api()
-    window = webview.create_window(
-        'SnarkyAI by mlwr.e',
-        html=html,
-        js_api=api,
-        min_size=(800, 600),
-        background_color='#1e1e1e',
-    )
-    webview.start(debug=False)
+    profile = StartupProfile()
+    profile.mark('imports')
+    parser = argparse.ArgumentParser(description='SnarkyAI desktop client')
+    parser.add_argument('--cache', action='store_true', help='cache text responses for identical requests')
+    parser.add_argument('--metrics-file', help='periodically write Prometheus metrics to this file')
+    parser.add_argument('--profile-startup', action='store_true', help='print a per-phase startup timing breakdown')
+    parser.add_argument('--http-pool-size', type=int, default=10, help='keep-alive connections per HTTP pool')
+    parser.add_argument('--dns-ttl', type=int, default=300, help='seconds to cache DNS lookups')
+    parser.add_argument('--warmup', action='store_true', help='pre-connect to the --backend-url server while typing')
+    parser.add_argument('--archive-after-days', type=float, default=0,
+                        help='compress chats older than this many days into monthly archive segments; '
+                             'archived chats are left out of search (default: off)')
+    parser.add_argument('--resident-chats', type=int, default=20, help='chats whose messages stay in memory')
+    parser.add_argument('--resident-mb', type=float, help='cap on resident message memory in megabytes')
+    parser.add_argument('--hedge', action='store_true',
+                        help="send a duplicate request to an alternate model when the first byte is later than the model's p90")
+    parser.add_argument('--hedge-budget', type=int, default=50, help='maximum hedged requests per day')
+    parser.add_argument('--backend-url', help='OpenAI-compatible endpoint to try first, e.g. http://localhost:8080/v1')
+    parser.add_argument('--backend-key', help='API key for --backend-url')
+    parser.add_argument('--fallback-model', default=AUTO_MODEL, help='g4f model used when the --backend-url server fails')
+    parser.add_argument('--deadline', type=float, default=120, help='seconds before a generation is stopped (0 disables)')
+    parser.add_argument('--flush-interval', type=float, default=0.5, help='seconds to batch history writes before flushing')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--log-sample', type=float, default=1.0, help='fraction of DEBUG/INFO events to keep')
+    parser.add_argument('--log-dir', help='directory for rotating JSON log files (default: ~/SnarkyAI/logs)')
+    parser.add_argument('--batch', metavar='INPUT', help="run prompts from a JSONL file ('-' for stdin) without the GUI")
+    parser.add_argument('--output', help='batch results JSONL file (default: stdout)')
+    parser.add_argument('--models', default=AUTO_MODEL, help='comma separated models for prompts that name none')
+    parser.add_argument('--workers', type=int, default=8, help='batch worker pool size')
+    parser.add_argument('--model-limit', action='append', default=[], metavar='[MODEL=]N',
+                        help='per-model concurrency cap; repeatable, a bare N sets the default')
+    parser.add_argument('--resume', action='store_true', help='skip prompts already completed in --output')
+    args = parser.parse_args()
+
+    setup_logging(args.log_level, args.log_sample, args.log_dir, sys.stderr if args.batch else sys.stdout)
+
+    if args.batch:
+        model_limit = 2
+        model_limits = {}
+        for limit in args.model_limit:
+            model, _, count = limit.rpartition('=')
+            if model:
+                model_limits[model] = int(count)
+            else:
+                model_limit = int(count)
+
+        done = BatchRunner.completed_ids(args.output) if args.resume else set()
+        if args.batch == '-':
+            tasks = BatchRunner.read_tasks(sys.stdin, args.models.split(','), done)
+        else:
+            with open(args.batch, 'r', encoding='utf-8') as f:
+                tasks = BatchRunner.read_tasks(f, args.models.split(','), done)
+        logging.info(f"Running {len(tasks)} batch prompts ({len(done)} already completed).")
+
+        api = Api(use_cache=args.cache, metrics_file=args.metrics_file, http_pool_size=args.http_pool_size,
+                  dns_ttl=args.dns_ttl, prewarm=False, archive_after_days=0, deadline=args.deadline,
+                  backend_url=args.backend_url, backend_key=args.backend_key, fallback_model=args.fallback_model)
+        output = open(args.output, 'a' if args.resume else 'w', encoding='utf-8') if args.output else sys.stdout
+        try:
+            summary = BatchRunner(api, output, args.workers, model_limit, model_limits).run(tasks)
+        except (OSError, ValueError) as e:
+            logging.error(f"Batch aborted because its output could not be written: {e}")
+            sys.exit(1)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+            api.close()
+        print(json.dumps(summary, indent=2), file=sys.stderr)
+        sys.exit(0)
+
+    with profile.phase('webview_import'):
+        import webview
+
+    with profile.phase('api_init'):
+        api = Api(use_cache=args.cache, metrics_file=args.metrics_file, load_async=True, profile=profile,
+                  profile_startup=args.profile_startup, http_pool_size=args.http_pool_size, dns_ttl=args.dns_ttl,
+                  prewarm=args.warmup, archive_after_days=args.archive_after_days,
+                  resident_chats=args.resident_chats,
+                  resident_bytes=int(args.resident_mb * 1024 * 1024) if args.resident_mb else None,
+                  flush_interval=args.flush_interval, hedge=args.hedge, hedge_budget=args.hedge_budget,
+                  deadline=args.deadline, backend_url=args.backend_url, backend_key=args.backend_key,
+                  fallback_model=args.fallback_model)
+    with profile.phase('window_create'):
+        window = webview.create_window(
+            'SnarkyAI by mlwr.e',
+            html=html,
+            js_api=api,
+            min_size=(800, 600),
+            background_color='#1e1e1e',
+        )
+    api.window = window
+    window.events.closing += api.flush
+    window.events.closed += api.close
+    webview.start(api.finish_startup, debug=False)
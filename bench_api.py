@@ -0,0 +1,162 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import SnarkyAI
+
+class _Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class FakeCompletions:
+    def __init__(self, latency, payload, chunk_size):
+        self.latency = latency
+        self.payload = payload
+        self.chunk_size = chunk_size
+
+    def create(self, model, messages, stream=False, **kwargs):
+        text = ('lorem ipsum ' * (self.payload // 12 + 1))[:self.payload]
+        if stream:
+            return self._stream(text)
+        time.sleep(self.latency)
+        return _Obj(choices=[_Obj(message=_Obj(content=text))])
+
+    def _stream(self, text):
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+        delay = self.latency / max(len(chunks), 1)
+        for chunk in chunks:
+            time.sleep(delay)
+            yield _Obj(choices=[_Obj(delta=_Obj(content=chunk))])
+
+class FakeImages:
+    def __init__(self, latency, payload):
+        self.latency = latency
+        self.data = base64.b64encode(b'\x89PNG\r\n\x1a\n' + os.urandom(payload)).decode('ascii')
+
+    def generate(self, model, prompt, **kwargs):
+        time.sleep(self.latency)
+        return _Obj(data=[_Obj(url=f"data:image/png;base64,{self.data}")])
+
+class FakeClient:
+    def __init__(self, latency=0.0, text_payload=2000, image_payload=4096, chunk_size=16):
+        self.chat = _Obj(completions=FakeCompletions(latency, text_payload, chunk_size))
+        self.images = FakeImages(latency, image_payload)
+
+def build_history(api, chats, messages_per_chat, message_size):
+    body = 'x' * message_size
+    now = time.time() - chats
+    history = []
+    for chat_id in range(chats):
+        messages = [{'user': body} if i % 2 == 0 else {'ai': body} for i in range(messages_per_chat)]
+        chat = {'id': chat_id, 'title': f"synthetic chat {chat_id}", 'timestamp': now + chat_id, 'messages': messages}
+        api.store.append_chat(chat)
+        api.store.append_messages(chat_id, messages)
+        history.append(chat)
+    api.store.compact(history)
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def measure(fn, iterations):
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        begin = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'iterations': iterations,
+        'throughput_per_s': iterations / elapsed if elapsed else None,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_memory_bytes': peak,
+    }
+
+def make_api(workdir, storage, client):
+    api = SnarkyAI.Api(os.path.join(workdir, 'chat_history.json'), storage=storage)
+    api.client = client
+    return api
+
+def run_size(args, storage, chats):
+    workdir = tempfile.mkdtemp(prefix='snarkyai-bench-')
+    try:
+        client = FakeClient(args.latency, args.text_payload, args.image_payload, args.chunk_size)
+        api = make_api(workdir, storage, client)
+        build_history(api, chats, args.messages_per_chat, args.message_size)
+        api.close()
+
+        results = {}
+        api = make_api(workdir, storage, client)
+        results['load_history'] = measure(api.load_history, args.load_iterations)
+        results['list_chats'] = measure(lambda: api.list_chats(0, 50), args.iterations)
+        results['open_chat'] = measure(lambda: api.open_chat(chats // 2), args.iterations)
+        results['search_history'] = measure(lambda: api.search_history('x', 20), args.iterations)
+        if chats <= args.max_full_history:
+            results['get_history'] = measure(api.get_history, args.load_iterations)
+
+        api.open_chat(chats - 1)
+        results['generate_text'] = measure(lambda: api.generate_text('gpt-4', 'benchmark prompt'), args.iterations)
+        results['generate_text_stream'] = measure(
+            lambda: api.generate_text('gpt-4', 'benchmark prompt', 'bench-stream'), args.iterations
+        )
+        results['generate_image'] = measure(lambda: api.generate_image('flux', 'benchmark image'), args.iterations)
+        results['save_history_to_file'] = measure(api.save_history_to_file, args.load_iterations)
+        api.close()
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SnarkyAI Api against an in-process fake provider')
+    parser.add_argument('--sizes', default='100,10000,100000', help='comma separated synthetic history sizes (chats)')
+    parser.add_argument('--storage', default=','.join(SnarkyAI.HISTORY_STORES), help='comma separated history stores')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--load-iterations', type=int, default=3)
+    parser.add_argument('--messages-per-chat', type=int, default=4)
+    parser.add_argument('--message-size', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0, help='fake provider latency in seconds')
+    parser.add_argument('--text-payload', type=int, default=2000, help='fake completion size in characters')
+    parser.add_argument('--image-payload', type=int, default=4096, help='fake image size in bytes')
+    parser.add_argument('--chunk-size', type=int, default=16, help='characters per streamed chunk')
+    parser.add_argument('--max-full-history', type=int, default=10000, help='largest size to run get_history on')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = {
+        'python': sys.version.split()[0],
+        'config': vars(args),
+        'results': {},
+    }
+    for storage in args.storage.split(','):
+        for chats in [int(size) for size in args.sizes.split(',')]:
+            print(f"Benchmarking {storage} store with {chats} chats...", file=sys.stderr)
+            report['results'].setdefault(storage, {})[str(chats)] = run_size(args, storage, chats)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
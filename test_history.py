@@ -0,0 +1,425 @@
+import base64
+import http.server
+import io
+import json
+import logging
+import socket
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import SnarkyAI
+from bench_api import FakeClient
+
+@pytest.fixture
+def make_api(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('USERPROFILE', str(tmp_path))
+    apis = []
+
+    def make(**kwargs):
+        api = SnarkyAI.Api(**kwargs)
+        apis.append(api)
+        return api
+
+    yield make
+    for api in apis:
+        if not api.closed.is_set():
+            api.close()
+
+def make_chat(chat_id, messages=()):
+    return {'id': chat_id, 'title': f"chat {chat_id}", 'timestamp': 1000.0 + chat_id, 'messages': list(messages)}
+
+def fill_journal(store, count):
+    chats = []
+    for chat_id in range(count):
+        chat = make_chat(chat_id, [{'user': f"question {chat_id}"}, {'ai': f"answer {chat_id}"}])
+        store.append_chat(chat)
+        store.append_messages(chat_id, chat['messages'])
+        chats.append(chat)
+    return chats
+
+def test_journal_compaction_keeps_every_chat(tmp_path):
+    history_file = str(tmp_path / 'chat_history.json')
+    store = SnarkyAI.HistoryJournal(history_file)
+    chats = fill_journal(store, 5)
+    store.compact(chats)
+    store.close()
+
+    store = SnarkyAI.HistoryJournal(history_file)
+    loaded = store.load()
+    store.compact(loaded)
+    store.close()
+
+    store = SnarkyAI.HistoryJournal(history_file)
+    assert [chat['id'] for chat in store.load()] == [0, 1, 2, 3, 4]
+    assert store.load_messages(0) == [{'user': 'question 0'}, {'ai': 'answer 0'}]
+    assert store.search('question')
+    store.close()
+
+@pytest.mark.parametrize('storage', sorted(SnarkyAI.HISTORY_STORES))
+def test_search_expands_prefixes_of_two_or_more_characters(tmp_path, storage):
+    store = SnarkyAI.HISTORY_STORES[storage](str(tmp_path / 'chat_history.json'))
+    store.append_chat(make_chat(0))
+    store.append_messages(0, [{'user': 'alpha beta'}, {'ai': 'alpine a'}, {'user': 'alpha alpha beta'}])
+    assert [result['index'] for result in store.search('al')][:1] == [2]
+    assert {result['index'] for result in store.search('al')} == {0, 1, 2}
+    assert [result['index'] for result in store.search('a')] == [1]
+    assert [result['index'] for result in store.search('beta alp')][:1] == [2]
+    assert store.search('missing al') == []
+    store.drop_messages(0)
+    assert store.search('al') == []
+    store.close()
+
+def test_corrupt_legacy_history_is_reported_and_retried(tmp_path, make_api):
+    legacy_file = tmp_path / 'SnarkyAI' / 'chat_history.json'
+    legacy_file.parent.mkdir()
+    legacy_file.write_text('[{"messages": [', encoding='utf-8')
+
+    api = make_api()
+    assert 'could not be migrated' in api.history_error
+    assert json.loads(api.list_chats())['total'] == 0
+    api.close()
+    assert legacy_file.exists()
+
+    legacy_file.write_text(json.dumps([
+        {'title': 'old', 'timestamp': 1.0, 'messages': [{'user': 'hi'}, {'ai': 'hello'}]},
+    ]), encoding='utf-8')
+    api = make_api()
+    assert api.history_error is None
+    chats = json.loads(api.list_chats())['chats']
+    assert [chat['title'] for chat in chats] == ['old']
+    assert not legacy_file.exists()
+    api.close()
+
+    api = make_api()
+    assert json.loads(api.list_chats())['total'] == 1
+
+def test_startup_defers_tokenizer_and_http_client(make_api):
+    api = make_api()
+    assert not api.context.encoding_loaded
+    assert api.http._client is None
+    assert api.context.count('four') >= 1
+    assert api.context.encoding_loaded
+
+def test_async_startup_opens_the_store_in_finish_startup(tmp_path, make_api):
+    api = make_api(load_async=True)
+    assert api.store is None
+    assert not (tmp_path / 'SnarkyAI' / 'chat_history.db').exists()
+    api.finish_startup(warm_client=False)
+    assert api.history_ready.is_set() and api.persister.store is api.store
+    assert (tmp_path / 'SnarkyAI' / 'chat_history.db').exists()
+    assert json.loads(api.search_history('anything'))['results'] == []
+
+def test_dns_cache_is_scoped_to_the_session(make_api):
+    resolve = socket.getaddrinfo
+    first, second = make_api(), make_api()
+    connection, _ = first.http._connection(('http', 'localhost', 9))
+    assert connection._create_connection == first.http.dns.create_connection
+    first.close()
+    second.close()
+    assert socket.getaddrinfo is resolve
+
+def test_batch_line_without_prompt_becomes_an_error_result():
+    lines = ['{"id": "a", "prompt": "hello"}', '{"id": "b", "kind": "text"}', 'plain prompt']
+    tasks = SnarkyAI.BatchRunner.read_tasks(lines, ['m'])
+    assert [task['id'] for task in tasks] == ['a:m', 'b:m', '3:m']
+    assert tasks[1]['error'] == "line 2: missing 'prompt'"
+    assert 'error' not in tasks[0] and 'error' not in tasks[2]
+    class EchoApi:
+        def run_prompt(self, kind, model, prompt, request_id=None):
+            return prompt.upper()
+
+    output = io.StringIO()
+    summary = SnarkyAI.BatchRunner(EchoApi(), output, workers=2).run(tasks)
+    results = {result['id']: result for result in map(json.loads, output.getvalue().splitlines())}
+    assert results['a:m']['result'] == 'HELLO'
+    assert results['b:m']['status'] == 'error' and 'line 2' in results['b:m']['error']
+    assert summary['count'] == 3 and summary['errors'] == 1
+
+def test_batch_stops_when_the_output_breaks():
+    class BrokenOutput(io.StringIO):
+        def write(self, data):
+            raise BrokenPipeError(32, 'Broken pipe')
+
+    class EchoApi:
+        def run_prompt(self, kind, model, prompt, request_id=None):
+            return prompt
+
+    tasks = SnarkyAI.BatchRunner.read_tasks([f"prompt {n}" for n in range(20)], ['m'])
+    runner = SnarkyAI.BatchRunner(EchoApi(), BrokenOutput(), workers=2)
+    with pytest.raises(BrokenPipeError):
+        runner.run(tasks)
+    assert runner.running == {'m': 0}
+
+def test_warm_up_is_opt_in_and_only_targets_session_backends(make_api):
+    assert json.loads(make_api().warm_up('gpt-4'))['warming'] == []
+
+    api = make_api(prewarm=True)
+    assert json.loads(api.warm_up('gpt-4'))['warming'] == []
+    api.model_backends = {'local-model': SnarkyAI.OpenAIBackend('http://127.0.0.1:9/v1', api.http)}
+    assert json.loads(api.warm_up('local-model'))['warming'] == ['http://127.0.0.1:9/v1']
+
+def test_data_url_payloads_stay_out_of_logs(make_api, caplog):
+    caplog.set_level(logging.DEBUG)
+    payload = base64.b64encode(b'\x89PNG\r\n\x1a\n' + b'x' * 3000).decode('ascii')
+    api = make_api()
+    assert api.get_image(f"data:image/png;base64,{payload}", 'full').startswith('data:image/png;base64,')
+    api.get_image('data:image/png;base64,!!!', 'full')
+    assert 'Cached image data:image/png;base64,<' in caplog.text
+    assert payload[100:200] not in caplog.text
+
+def start_chat(api, prompt):
+    api.save_chat()
+    assert not api.generate_text('gpt-4', prompt).startswith('Error')
+    return api.current_chat_id
+
+def test_archiving_is_opt_in_and_leaves_the_resident_set_alone(make_api):
+    api = make_api()
+    assert api.archive_after_days == 0
+    api.client = FakeClient(text_payload=40)
+    old = [start_chat(api, f"old chat {n}") for n in range(2)]
+    start_chat(api, 'current chat')
+    for chat_id in old:
+        api.chat_index[chat_id]['timestamp'] = 86400.0
+    api.flush()
+    api.chat_index[old[0]]['messages'] = None
+    api.resident.discard(old[0])
+    loads = api.resident.loads
+
+    api.archive_after_days = 30
+    assert api.archive_old_chats()['chats'] == 2
+    assert api.resident.loads == loads
+    assert all(api.chat_index[chat_id]['messages'] is None for chat_id in old)
+    assert json.loads(api.open_chat(old[0]))['messages'][0] == {'user': 'old chat 0'}
+
+class FailingStore:
+    def __init__(self, store, failures=1):
+        self.store = store
+        self.failures = failures
+        self.calls = 0
+
+    def append_messages(self, chat_id, messages):
+        self.calls += 1
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError('database or disk is full')
+        self.store.append_messages(chat_id, messages)
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+@pytest.mark.parametrize('storage', sorted(SnarkyAI.HISTORY_STORES))
+def test_persister_retries_failed_writes_and_reports_failure(tmp_path, storage):
+    store = SnarkyAI.HISTORY_STORES[storage](str(tmp_path / 'chat_history.json'))
+    failing = FailingStore(store)
+    errors = []
+    persister = SnarkyAI.Persister(failing, lambda: None, interval=0.01, on_error=errors.append, retry_delay=0.05)
+    persister.submit('chat', 0, make_chat(0))
+    persister.submit('messages', 0, [{'user': 'first'}, {'ai': 'answer'}])
+
+    assert not persister.flush()
+    assert persister.error == 'database or disk is full'
+    assert errors == ['database or disk is full']
+    assert persister.is_dirty(0)
+
+    assert persister.flush()
+    assert persister.error is None and not persister.is_dirty(0)
+    assert failing.calls == 2
+    assert store.load_messages(0) == [{'user': 'first'}, {'ai': 'answer'}]
+    assert persister.close()
+    store.close()
+
+    store = SnarkyAI.HISTORY_STORES[storage](str(tmp_path / 'chat_history.json'))
+    assert [chat['id'] for chat in store.load()] == [0]
+    assert store.load_messages(0) == [{'user': 'first'}, {'ai': 'answer'}]
+    store.close()
+
+def test_api_keeps_unwritten_turns_and_reports_failed_flush(make_api):
+    api = make_api(resident_chats=1)
+    api.client = FakeClient(text_payload=40)
+    api.store = api.persister.store = FailingStore(api.store, failures=1000)
+    chat_id = start_chat(api, 'first')
+    assert api.save_history_to_file() is False
+    assert api.persister.error == 'database or disk is full'
+    for n in range(3):
+        start_chat(api, f"later {n}")
+    assert api.chat_index[chat_id]['messages'] is not None
+
+    api.persister.store.failures = 0
+    assert api.save_history_to_file() is True
+    assert api.store.load_messages(chat_id)[0] == {'user': 'first'}
+    assert len(api.store.load_messages(chat_id)) == 2
+
+def test_journal_discards_a_partial_append(tmp_path):
+    history_file = str(tmp_path / 'chat_history.json')
+    store = SnarkyAI.HistoryJournal(history_file)
+    store.append_chat(make_chat(0))
+    real = store._journal
+
+    class DiskFull:
+        def __getattr__(self, name):
+            return getattr(real, name)
+
+        def write(self, data):
+            real.write(data[:10])
+            real.flush()
+            raise OSError(28, 'No space left on device')
+
+    store._journal = DiskFull()
+    with pytest.raises(OSError):
+        store.append_messages(0, [{'user': 'lost'}])
+    store.append_messages(0, [{'user': 'kept'}])
+    store.close()
+
+    store = SnarkyAI.HistoryJournal(history_file)
+    assert store.load()[0]['messages'] == [{'user': 'kept'}]
+    store.close()
+
+def test_restoring_an_archived_chat_survives_a_crash_before_the_flush(make_api):
+    api = make_api(flush_interval=3600)
+    api.client = FakeClient(text_payload=40)
+    old = start_chat(api, 'old chat')
+    start_chat(api, 'current chat')
+    api.chat_index[old]['timestamp'] = 86400.0
+    api.archive_after_days = 30
+    assert api.archive_old_chats()['chats'] == 1
+    api.flush()
+
+    api._restore_chat(api.chat_index[old])
+    crashed = make_api()
+    chat = next(chat for chat in json.loads(crashed.list_chats())['chats'] if chat['id'] == old)
+    assert chat['archived']
+    assert len(json.loads(crashed.open_chat(old))['messages']) == 2
+    crashed.close()
+
+    api.flush()
+    restarted = make_api()
+    chat = next(chat for chat in json.loads(restarted.list_chats())['chats'] if chat['id'] == old)
+    assert not chat['archived']
+    assert len(json.loads(restarted.open_chat(old))['messages']) == 2
+
+def test_hedge_latency_is_credited_to_the_model_that_answered(make_api):
+    api = make_api(hedge=True)
+    api.client = FakeClient(text_payload=40)
+    create = api.client.chat.completions.create
+
+    def slow_primary(model, messages, stream=False, **kwargs):
+        time.sleep(1.0 if model == 'gpt-4' else 0.0)
+        return create(model, messages, stream, **kwargs)
+
+    api.client.chat.completions.create = slow_primary
+    for _ in range(SnarkyAI.HEDGE_MIN_SAMPLES):
+        api.router.record_first_byte('gpt-4', 0.1)
+    alternate = api.router.alternate('gpt-4')
+    assert not api.generate_text('gpt-4', 'hello').startswith('Error')
+
+    stats = json.loads(api.get_model_stats())
+    assert api.hedge_budget.get_stats()['won'] == 1
+    assert stats[alternate]['requests'] == 1 and stats[alternate]['ewma'] < 0.1
+    assert stats['gpt-4']['requests'] == 1 and stats['gpt-4']['ewma'] >= 0.1
+
+def test_a_cancelled_stream_is_not_a_successful_empty_answer(make_api):
+    api = make_api()
+    api.client = FakeClient(text_payload=200, chunk_size=10)
+    token = SnarkyAI.CancelToken()
+    api.local.cancel = token
+    api._push = lambda function, payload: token.cancel()
+    with pytest.raises(SnarkyAI.GenerationCancelled) as cancelled:
+        api._stream_completion('gpt-4', [{'role': 'user', 'content': 'hi'}], 'stream')
+    assert cancelled.value.partial == 'lorem ipsu'
+
+    with pytest.raises(RuntimeError):
+        api.router.run('gpt-4', lambda candidate, timeout: (None, None))
+    assert json.loads(api.get_model_stats())['gpt-4']['errors'] == 1
+
+def test_cancelling_a_request_aborts_its_connection():
+    release = threading.Event()
+
+    class SlowHandler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path == '/slow':
+                release.wait(5)
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    session = SnarkyAI.HttpSession()
+    session.client_ready = True
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        token = SnarkyAI.CancelToken()
+        assert session.request_json('POST', f"{url}/fast", {}, cancel=token) == {}
+        assert token.callbacks == []
+
+        threading.Timer(0.2, token.cancel).start()
+        start = time.monotonic()
+        with pytest.raises(SnarkyAI.GenerationCancelled):
+            session.request_json('POST', f"{url}/slow", {}, cancel=token)
+        assert time.monotonic() - start < 2
+    finally:
+        release.set()
+        session.close()
+        server.shutdown()
+        server.server_close()
+
+def test_a_generation_that_fails_to_start_is_cleaned_up(make_api, monkeypatch):
+    api = make_api()
+
+    def broken_chat(title=''):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(api, '_ensure_chat', broken_chat)
+    assert api.generate_text('gpt-4', 'hello', 'request') == 'Error: No space left on device'
+    assert api.cancels == {}
+    assert api.tracer.current() is None
+    assert api.tracer.get('request')['outcome'] == 'error'
+
+def test_merged_cache_waiters_cancel_independently_of_the_owner(tmp_path):
+    cache = SnarkyAI.ResponseCache(str(tmp_path / 'cache.db'))
+    release = threading.Event()
+    started = threading.Event()
+
+    def owner_compute():
+        started.set()
+        release.wait(5)
+        raise SnarkyAI.GenerationCancelled('cancelled', 'owner partial')
+
+    results = {}
+
+    def run(name, compute, token):
+        try:
+            results[name] = cache.get_or_compute('key', compute, wait=token.wait)
+        except SnarkyAI.GenerationCancelled as e:
+            results[name] = ('cancelled', e.partial)
+
+    owner = threading.Thread(target=run, args=('owner', owner_compute, SnarkyAI.CancelToken()))
+    owner.start()
+    assert started.wait(5)
+
+    cancelled_token = SnarkyAI.CancelToken()
+    cancelled = threading.Thread(target=run, args=('cancelled', lambda: 'unused', cancelled_token))
+    cancelled.start()
+    retried = threading.Thread(target=run, args=('retried', lambda: 'own answer', SnarkyAI.CancelToken()))
+    retried.start()
+    time.sleep(0.1)
+    cancelled_token.cancel()
+    cancelled.join(5)
+    assert results['cancelled'] == ('cancelled', '')
+    assert owner.is_alive()
+
+    release.set()
+    owner.join(5)
+    retried.join(5)
+    assert results['owner'] == ('cancelled', 'owner partial')
+    assert results['retried'] == 'own answer'
+    assert cache.stats['merged'] == 2
+    cache.close()